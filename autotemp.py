@@ -15,8 +15,10 @@ from tmodel.tempfit import model_fit
 # pull the adcp tables
 lake = "OWS19"
 directory = "/home/mpoe/adcp_habs/data/adcp_tables_stacked/"
-adp = pd.read_csv(directory + "/" + lake + "/" + lake + "_mb_av.csv")
-adp_ts = pd.read_csv(directory + "/" + lake + "/" + lake + "_converted_time_series.csv")
+# paths only: select reads just the time window and depth column it needs, through the sidecar
+# index of the stacked csv's when they have one
+adp = directory + "/" + lake + "/" + lake + "_mb_av.csv"
+adp_ts = directory + "/" + lake + "/" + lake + "_converted_time_series.csv"
 
 # flx csv
 flx = pd.read_csv("/home/mpoe/adcp_habs/data/flx_data/flx_most_recent.csv").dropna()
@@ -6,17 +6,33 @@ Ex: for Owasco 2019 we might use OWS19000.000, OWS19001.PDO etc...
 """
 
 import os
+import sys
 import glob
+import json
+import heapq
+import argparse
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from functools import partial
 from pathlib import Path
 import numpy as np
 import pandas as pd
-import rpy2.robjects as robjects
 
 from temp_module import tempmb
 from temp_module.constants import *
-from tables.subsetter import subset_adcp
-from tables.conjoiner import aggr_df
-from tables.converter import tec, mb_build
+from temp_module.geometry import bin_geometry
+from tables.subsetter import BEAM_TABLES, subset_adcp
+from tables.conjoiner import aggr_df, inputs
+from tables.converter import tec, mb_build_beams
+from tables.storage import FORMATS, apply_schema, read_table
+from tables.instrument import RunReport
+from tables.pipeline import Pipeline, Stage
+try:
+    import resource
+except ImportError:
+    # no per job memory limits on windows
+    resource = None
 
 ######################################################################################
 def chg_str(fl):
@@ -33,11 +49,116 @@ def chg_str(fl):
 
 ######################################################################################
 
-def auto_mb(raw_dir, end_dir, eyedee):
+# stage code versions, bump one when its code changes what it writes to redo it on the next run
+STAGE_VERSIONS = {"subset": 1, "aggr_df": 1, "tec": 1, "mb_build": 1}
+
+# array for looping through all of the categories and build all tables in one go
+CATEGORIES = ["amp_avg", "amp_beam1", "amp_beam2", "amp_beam3", "amp_beam4", "corr_bm1", "corr_bm2", "corr_bm3", "corr_bm4", 
+            "prcnt_good_bm1", "prcnt_good_bm2", "prcnt_good_bm3", "prcnt_good_bm4", "table_time_series", "vel_E_W", 
+            "vel_err", "vel_N_S", "vel_x_vrt", ]
+BEAMS = ['beam1', 'beam2', 'beam3', 'beam4', 'avg']
+
+
+def _stack_stage(eyedee, category, direct1, direct2, fmt, compact, sort_key, budget, dedupe, *deps):
+    # with a budget the table is merged to disk and only its row count comes back, dependents read
+    # it through _load_stacked when they run
+    return(aggr_df(eyedee, category, direct1, direct2, sort_key=sort_key, fmt=fmt, compact=compact, budget=budget,
+                   dedupe=dedupe))
+
+
+def _load_stacked(category, compact, outputs):
+    df = read_table(outputs[0])
+    return(apply_schema(df, category) if compact else df)
+
+
+def _tec_stage(pt_file, ts):
+    return(tec(ts, pt_file))
+
+
+def _mb_stage(pt_files, dtype, ts, bins, *amps):
+    # every beam in one batch: the sonar geometry and the per ensemble terms are computed once
+    geometry = bin_geometry(np.unique(bins["bin_depth"]))
+    tables = mb_build_beams(dict(zip(BEAMS, amps)), ts, dict(zip(BEAMS, pt_files)), geometry=geometry, dtype=dtype)
+    return(sum(len(x) for x in tables.values()))
+
+
+def mb_pipeline(files, eyedee, direct1, direct2, cache_dir, fmt="csv", compact=False, report=None, budget=None,
+                dedupe=None):
+    """
+    Lay out auto_mb as a tables.pipeline.Pipeline:
+    subset per raw file -> aggr_df per category -> tec, and mb_build of all beams at once
+    Stages are keyed by the contents of the raw files and of the separated tables each aggr_df
+    stacks, the stage versions, fmt and compact, and temp_module.constants for tec and mb_build;
+    see tables.pipeline
+    budget: rows in memory while stacking, see tables.conjoiner.merge_sorted; all in memory by default
+    dedupe: drop the ensembles repeated where raw files overlap from the time ordered stacked tables,
+        on by default with budget, see tables.conjoiner.aggr_df
+    """
+    ext = FORMATS[fmt]
+    params = {"fmt": fmt, "compact": compact}
+    dedupe = budget is not None if dedupe is None else dedupe
+    pipe = Pipeline(cache_dir, report=report)
+
+    subsets = []
+    for file in files:
+        laek_eyedee = chg_str(file)
+        outputs = [direct1 + laek_eyedee + "/" + laek_eyedee + "_" + x + ext
+                   for x in list(BEAM_TABLES) + ["table_time_series", "table_bins"]]
+        pipe.add(Stage("subset:" + file, partial(subset_adcp, file, laek_eyedee, direct1, fmt=fmt, compact=compact),
+                       outputs, files=[file], version=STAGE_VERSIONS["subset"], params=params, parallel=True,
+                       isolate=True))
+        subsets.append("subset:" + file)
+
+    # filepath = "/home/mpoe/adcp_habs/data/adcp_tables_stacked/OWS19/OWS19_" 
+    filepath = direct2 + eyedee + "/" + eyedee + "_"
+    for i in CATEGORIES + ["table_bins"]:
+        sort_key = "bin_depth" if i == "table_bins" else "time"
+        # every file repeats the bin depths, they are not duplicated ensembles
+        unique = dedupe and sort_key == "time"
+        # the separated tables are globbed once the subsets ran, new or changed ones change the key
+        stack = partial(_stack_stage, eyedee, i, direct1, direct2, fmt, compact, sort_key, budget, unique)
+        pipe.add(Stage("aggr_df:" + i, stack, [filepath + i + ext], deps=subsets,
+                       files=partial(inputs, eyedee, i, direct1, fmt), version=STAGE_VERSIONS["aggr_df"],
+                       params=dict(params, dedupe=unique), load=partial(_load_stacked, i, compact)))
+
+    pipe.add(Stage("tec", partial(_tec_stage, filepath + "converted_time_series" + ext),
+                   [filepath + "converted_time_series" + ext], deps=["aggr_df:table_time_series"],
+                   version=STAGE_VERSIONS["tec"], params=params, constants=True,
+                   reads=[filepath + "table_time_series" + ext]))
+
+    mb_dtype = np.float32 if compact else np.float64
+    mb_files = [filepath + "mb_" + i + ext for i in BEAMS]
+    mb_inputs = ["table_time_series", "table_bins"] + ["amp_" + i for i in BEAMS]
+    pipe.add(Stage("mb_build", partial(_mb_stage, mb_files, mb_dtype), mb_files,
+                   deps=["aggr_df:" + x for x in mb_inputs], version=STAGE_VERSIONS["mb_build"], params=params,
+                   constants=True, reads=[filepath + x + ext for x in mb_inputs]))
+    return(pipe)
+
+
+def auto_mb(raw_dir, end_dir, eyedee, fmt="csv", workers=1, compact=False, report=True, profiler=None,
+            trace_memory=False, force=False, budget=None, dedupe=None):
     """
     Takes the three input params and spits out the final converted data tables for each beam 
     Convention: include a trailing slash '/ at the end of any filepath name
+    fmt: "csv", "parquet" or "feather", storage format for every table written; see tables.storage
+    workers: number of processes subsetting raw files in parallel, os.cpu_count() is a good choice
+    compact: keep counts as uint8, time as datetime64 and velocities and backscatter as float32 end to end
+    report: save time, cpu, rows, bytes and memory of every stage and input file to
+        end_dir/adcp_tables_stacked/<eyedee>/<eyedee>_run_report.json; see tables.instrument
+    profiler: "cprofile" to profile the whole run next to the report, or a callable
+        profiler(stage, file) returning a context manager wrapped around every stage
+    trace_memory: also report the peak python/numpy allocations of each stage, slows the run down
+    force: rerun every stage; otherwise stages whose inputs, constants and code did not change since
+        they last finished are skipped, stamps are kept in end_dir/.adcp_cache/<eyedee>/; see mb_pipeline
+    budget: rows held in memory while stacking a category, merged out of core when set, ex: 5000000;
+        see tables.conjoiner.merge_sorted
+    dedupe: keep one row per time in the stacked tables where raw files overlap; on by default with
+        budget, off otherwise
+    Returns a dict of raw files that could not be subset and their errors
     """
+    run = RunReport(profiler=profiler, trace_memory=trace_memory, eyedee=eyedee, raw_dir=raw_dir,
+                    end_dir=end_dir, fmt=fmt, workers=workers, compact=compact, budget=budget,
+                    dedupe=dedupe).start()
 
     direct1 = end_dir +"adcp_data_tables/"
     direct2 = end_dir+"adcp_tables_stacked/"
@@ -52,67 +173,142 @@ def auto_mb(raw_dir, end_dir, eyedee):
     except OSError as error:
         print(error)
 
-    for file in glob.glob(raw_dir+"*/*"+eyedee+"*"):
-        print(file)
-        laek_eyedee = chg_str(file)
-        print(laek_eyedee)
+    ######################################################################################
+    # subsetter; tables land in direct1/<id>/, ex: "/home/mpoe/adcp_habs/data/adcp_data_tables/SEN19000/"
+    with run.stage("glob") as rec:
+        files = sorted(glob.glob(raw_dir+"*/*"+eyedee+"*"))
+        rec["rows"] = len(files)
+    print("now on to subset", len(files), "files")
+
+    ######################################################################################
+    # subset -> conjoin -> convert -> mb, skipping every stage that is already up to date
+    # one cache per lake-year, their stage names are the same
+    cache_dir = os.path.join(end_dir, ".adcp_cache", eyedee)
+    pipe = mb_pipeline(files, eyedee, direct1, direct2, cache_dir, fmt=fmt, compact=compact, report=run,
+                       budget=budget, dedupe=dedupe)
+    status = pipe.run(force=force, workers=workers)
+    failed = {k.split(":", 1)[1]: v[len("failed: "):] for k, v in status.items()
+              if k.startswith("subset:") and v.startswith("failed")}
 
-        ######################################################################################
-        # subsetter
-        # ex: csv_dir = "/home/mpoe/adcp_habs/data/adcp_data_tables/SEN19000"
-        csv_dir = direct1+laek_eyedee+"/"
+    if report:
+        pt_report = direct2 + eyedee + "/" + eyedee + "_run_report.json"
+        run.save(pt_report, failed=failed, status=status)
+        print("run report:", pt_report)
+    return(failed)
+
+
+######################################################################################
+def _batch_job(job, conn):
+    """run one job of auto_mb_batch in its own process: memory limit, log file, auto_mb"""
+    if job["memory_mb"] and resource is not None:
+        # address space, a little above the resident memory the job can reach
+        limit = int(job["memory_mb"] * 2**20)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    with open(job["log"], "a") as log:
+        sys.stdout = sys.stderr = log
         try:
-            os.makedirs(csv_dir, exist_ok=True)
-        except OSError as error:
-            print(error)
+            failed = auto_mb(job["raw_dir"], job["end_dir"], job["eyedee"], **job["options"])
+            conn.send(("done", {k: str(v) for k, v in failed.items()}))
+        except BaseException as error:
+            traceback.print_exc()
+            conn.send(("error", repr(error)))
 
-        print("now on to subset")
 
-        subset_adcp(file, laek_eyedee, csv_dir) # module py2 not working in all environments
-    ######################################################################################
-    # conjoiner 
-    # array for looping through all of the categories and build all tables in one go
-    categories = ["amp_avg", "amp_beam1", "amp_beam2", "amp_beam3", "amp_beam4", "corr_bm1", "corr_bm2", "corr_bm3", "corr_bm4", 
-                "prcnt_good_bm1", "prcnt_good_bm2", "prcnt_good_bm3", "prcnt_good_bm4", "table_time_series", "vel_E_W", 
-                "vel_err", "vel_N_S", "vel_x_vrt", ]
-    
-    # a single lake-year: tables for all categories
-    for i in categories: 
-        tester = aggr_df(eyedee, i, direct1, direct2)
-    # bins table 
-    aggr_df(eyedee, "table_bins", direct1, direct2, sort_key="bin_depth")
+def auto_mb_batch(jobs, workers=2, memory_budget=None, retries=1, report=None):
+    """
+    Run auto_mb for many lake-years at once without prompts
+    Jobs run in their own processes so one job's subsetting and writing overlaps another's conjoining
+    and mb builds. A job that fails or runs out of memory is retried; the stage cache of auto_mb
+    makes a retry resume from the stage that did not finish.
 
-    ######################################################################################
-    # ts table builder
-    # filepath = "/home/mpoe/adcp_habs/data/adcp_data_tables/OWS19002/OWS19002_" 
-    # filepath = final_dir + adp_id + "/" + adp_id + "_" # file path
-    filepath = direct2+ adp_id + "/" + adp_id + "_" 
+    jobs: list of dicts, one per lake-year, ex:
+        {"eyedee": "OWS19", "raw_dir": ".../RawDataClean/", "end_dir": ".../data/",
+         "priority": 1, "memory_mb": 8000, "options": {"fmt": "parquet", "workers": 2}}
+        priority: higher runs first, default 0
+        memory_mb: address space limit of the job process, none by default
+        options: extra auto_mb arguments
+        log: file receiving the job output, default end_dir/<eyedee>_auto_mb.log
+    workers: jobs running at the same time
+    memory_budget: MB shared by the running jobs, a job only starts when its memory_mb fits
+        (a job larger than the budget still runs, alone)
+    retries: extra attempts of a failed job
+    report: optional json file for the results
+    Returns a dict of eyedee: {"status": "done" or "failed", "attempts", "failed_files" or "error"}
+    """
+    queue = []
+    for k, x in enumerate(jobs):
+        job = {"priority": 0, "memory_mb": None, "options": {}}
+        job.update(x)
+        job.setdefault("log", job["end_dir"] + job["eyedee"] + "_auto_mb.log")
+        os.makedirs(job["end_dir"], exist_ok=True)
+        # highest priority first, then in the given order
+        heapq.heappush(queue, (-job["priority"], k, 1, job))
 
-    ######################################################################################
-    # time series conversion build
-    temp_check = pd.read_csv(filepath + "table_time_series.csv")
-    pnt_dir1 = filepath + "converted_time_series.csv"
-    test_ts = tec(temp_check, pnt_dir1) # works without explicit function call, the table write is built in
+    running = {}
+    results = {}
+    while queue or running:
+        # start every job that fits
+        while queue and len(running) < workers:
+            job = queue[0][3]
+            used = sum(x[1]["memory_mb"] or 0 for x in running.values())
+            if memory_budget and running and used + (job["memory_mb"] or 0) > memory_budget:
+                break
+            order, k, attempt, job = heapq.heappop(queue)
+            recv, send = mp.Pipe(duplex=False)
+            p = mp.Process(target=_batch_job, args=(job, send), name=job["eyedee"])
+            p.start()
+            send.close()
+            running[recv] = (p, job, attempt, (order, k))
+            print("started", job["eyedee"], "attempt", attempt, "log:", job["log"])
 
-    ######################################################################################
-    # mb table builder
-    # pull time series and amplitude tables 
-    cats = ['beam1', 'beam2', 'beam3', 'beam4', 'avg']
-    #generate mb tables 
-    for i in cats:
-        amp_check = pd.read_csv(filepath + "amp_" + i + ".csv") 
-        pnt_dir_mb = filepath + "mb_" + i + ".csv"
-        test_df = mb_build(amp_check, temp_check, pnt_dir_mb)
-        # print(len(test_df), '\n' , test_df.iloc[10000, :])
+        # a job's pipe is ready once it sent its result, or at EOF once it died without one; reading
+        # before joining lets a child blocked on a result larger than the pipe buffer finish
+        for recv in wait(list(running)):
+            p, job, attempt, order = running.pop(recv)
+            try:
+                msg = recv.recv()
+            except EOFError:
+                msg = None
+            p.join()
+            recv.close()
+            if msg is None:
+                msg = ("error", "exit code " + str(p.exitcode))
+            if msg[0] == "done":
+                results[job["eyedee"]] = {"status": "done", "attempts": attempt, "failed_files": msg[1]}
+                print("done", job["eyedee"], "failed files:", len(msg[1]))
+            elif attempt <= retries:
+                print("retrying", job["eyedee"] + ":", msg[1])
+                heapq.heappush(queue, (order[0], order[1], attempt + 1, job))
+            else:
+                results[job["eyedee"]] = {"status": "failed", "attempts": attempt, "error": msg[1]}
+                print("FAILED", job["eyedee"] + ":", msg[1])
+
+    if report is not None:
+        with open(report, "w") as f:
+            json.dump(results, f, indent=1)
+    return(results)
 
 
 if __name__ == '__main__':
+    # batch mode: python backscatter.py --batch jobs.json --jobs 3, with a list of jobs as in auto_mb_batch
+    parser = argparse.ArgumentParser(description="build the adcp tables of one or many lake-years")
+    parser.add_argument("--batch", default=None, help="json file with the list of auto_mb_batch jobs")
+    parser.add_argument("--jobs", type=int, default=2, help="lake-years running at once")
+    parser.add_argument("--memory-budget", type=float, default=None, help="MB shared by the running jobs")
+    parser.add_argument("--retries", type=int, default=1)
+    parser.add_argument("--report", default=None, help="json file for the batch results")
+    args = parser.parse_args()
+
+    if args.batch is not None:
+        with open(args.batch) as f:
+            auto_mb_batch(json.load(f), workers=args.jobs, memory_budget=args.memory_budget, retries=args.retries,
+                          report=args.report)
+        sys.exit()
+
     # ex: df_adcp = "/home/mpoe/adcp_habs/data/RawDataClean/"
     df_adcp = input("Enter raw data filepath path. Example: ~/user/data/raw_data/")
     # ex: /home/mpoe/adcp_habs/data/
     final_dir = input("Enter storage filepath path. Example: ~/user/data/")
     # ex: adp_id = 'SEN19280' 
     adp_id = input("Please enter an experiment ID. Example: 'SEN19' will work for all Seneca 2019 adcp files named SEN1900x...")
-    auto_mb(df_adcp, final_dir, adp_id)
-
-        
\ No newline at end of file
+    auto_mb(df_adcp, final_dir, adp_id)
\ No newline at end of file
@@ -0,0 +1,212 @@
+""" Throughput benchmarks for every stage of the adcp pipeline on synthetic deployments
+
+Each stage runs in its own forked process so its peak RSS is measured on its own: the RSS the child
+inherits from this interpreter at fork is subtracted, what remains is the memory of the stage's
+inputs and work. Inputs are loaded before the clock starts. Run from the repository root, ex:
+
+    python -m benchmarks.bench --lake OWS --scales day week month --files 4 --json bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing as mp
+
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
+
+from benchmarks.synthetic import deployment, flx_table
+from temp_module import tempmb
+from tables.subsetter import subset_adcp
+from tables.conjoiner import aggr_df
+from tables.converter import tec, mb_build, mb_build_beams
+from tmodel import tempfit
+
+# deployment lengths in days
+SCALES = {"day": 1, "week": 7, "month": 30, "season": 120, "year": 365, "3year": 1095}
+
+CATEGORIES = ["amp_avg", "amp_beam1", "amp_beam2", "amp_beam3", "amp_beam4", "corr_bm1", "corr_bm2", "corr_bm3",
+              "corr_bm4", "prcnt_good_bm1", "prcnt_good_bm2", "prcnt_good_bm3", "prcnt_good_bm4", "table_time_series",
+              "vel_E_W", "vel_err", "vel_N_S", "vel_x_vrt"]
+BEAMS = ["beam1", "beam2", "beam3", "beam4", "avg"]
+
+
+######################################################################################
+# stages: each takes the workspace and returns (setup, run); setup loads inputs before timing
+# and run returns the number of rows processed
+######################################################################################
+def stage_subset(ws):
+    def run(_):
+        for f in ws["files"]:
+            subset_adcp(f, os.path.basename(f).split("r.")[0], ws["tables"])
+        return (ws["n"])
+    return (None, run)
+
+
+def stage_conjoin(ws):
+    def run(_):
+        for i in CATEGORIES:
+            aggr_df(ws["id"], i, ws["tables"], ws["stacked"])
+        return (ws["n"] * len(CATEGORIES))
+    return (None, run)
+
+
+def _stacked(ws, name):
+    return (pd.read_csv(ws["stacked"] + ws["id"] + "/" + ws["id"] + "_" + name + ".csv"))
+
+
+def stage_tec(ws):
+    return (lambda: _stacked(ws, "table_time_series"), lambda ts: len(tec(ts)))
+
+
+def stage_mb_build(ws):
+    def setup():
+        return (_stacked(ws, "table_time_series"), {i: _stacked(ws, "amp_" + i) for i in BEAMS})
+
+    def run(x):
+        ts, amps = x
+        return (sum(len(mb_build(amps[i], ts)) for i in BEAMS))
+    return (setup, run)
+
+
+def stage_mb_beams(ws):
+    def setup():
+        return (_stacked(ws, "table_time_series"), {i: _stacked(ws, "amp_" + i) for i in BEAMS})
+
+    def run(x):
+        ts, amps = x
+        return (sum(len(v) for v in mb_build_beams(amps, ts).values()))
+    return (setup, run)
+
+
+def stage_tempmb(ws):
+    """the original per column evaluation: one TempMb per depth column of amp_avg"""
+    def setup():
+        return (_stacked(ws, "table_time_series"), _stacked(ws, "amp_avg"))
+
+    def run(x):
+        ts, amp = x
+        for c in amp.columns[1:]:
+            tempmb.TempMb(float(c), amp[c], ts["temp"], ts["attitude_T"], ts["ambient_T"]).measured_backscatter()
+        return (len(amp))
+    return (setup, run)
+
+
+def _fit_inputs(ws):
+    mb = _stacked(ws, "mb_avg") if os.path.exists(ws["stacked"] + ws["id"] + "/" + ws["id"] + "_mb_avg.csv") else None
+    if mb is None:
+        ts, amp = _stacked(ws, "table_time_series"), _stacked(ws, "amp_avg")
+        mb = mb_build(amp, ts)
+    return (mb, pd.read_csv(ws["flx"]))
+
+
+def stage_select(ws):
+    def run(x):
+        mb, flx = x
+        adp, fl = tempfit.select(mb, flx, ws["start"], ws["end"], depth=8)
+        return (len(mb))
+    return (lambda: _fit_inputs(ws), run)
+
+
+def stage_model_fit(ws):
+    def run(x):
+        mb, flx = x
+        tempfit.model_fit(mb, flx, ws["start"], ws["end"], depth=8)
+        return (len(mb))
+    return (lambda: _fit_inputs(ws), run)
+
+
+STAGES = {"subset_adcp": stage_subset, "aggr_df": stage_conjoin, "tec": stage_tec, "mb_build": stage_mb_build,
+          "mb_build_beams": stage_mb_beams, "TempMb": stage_tempmb, "tempfit.select": stage_select,
+          "tempfit.model_fit": stage_model_fit}
+
+
+######################################################################################
+def _rss_mb():
+    # ru_maxrss is in kB on linux; a forked child starts from the RSS it was forked with
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def _child(name, ws, queue):
+    try:
+        base = _rss_mb()
+        setup, run = STAGES[name](ws)
+        x = setup() if setup is not None else None
+        t0, c0 = time.perf_counter(), time.process_time()
+        rows = run(x)
+        wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+        queue.put({"wall_s": wall, "cpu_s": cpu, "rows": rows, "rows_per_s": rows / wall if wall else None,
+                   "peak_rss_mb": _rss_mb() - base, "base_rss_mb": base})
+    except Exception as error:
+        queue.put({"error": repr(error)})
+
+
+def run_stage(name, ws):
+    """time one stage in a forked process and return its measurements"""
+    ctx = mp.get_context("fork")
+    queue = ctx.Queue()
+    p = ctx.Process(target=_child, args=(name, ws, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return (result)
+
+
+def run_scale(lake, scale, files, stages, work_dir, seed=0, interval="5min"):
+    """generate one synthetic deployment and benchmark the requested stages on it"""
+    days = SCALES[scale]
+    root = os.path.join(work_dir, lake + "_" + scale) + "/"
+    eyedee, paths = deployment(root + "raw", lake=lake, days=days, files=files, interval=interval, seed=seed)
+    flx_path = root + "flx.csv"
+    flx_table(lake, days=days, seed=seed).to_csv(flx_path, index=False)
+
+    start = pd.Timestamp("2019-06-01")
+    ws = {"id": eyedee, "files": paths, "tables": root + "adcp_data_tables/", "stacked": root + "adcp_tables_stacked/",
+          "flx": flx_path, "n": len(pd.date_range(start, start + pd.Timedelta(days=days), freq=interval,
+                                                   inclusive="left")),
+          "start": str(start), "end": str(start + pd.Timedelta(days=days))}
+
+    report = []
+    for name in stages:
+        result = run_stage(name, ws)
+        result.update({"stage": name, "lake": lake, "scale": scale, "ensembles": ws["n"], "files": files})
+        report.append(result)
+        print(_line(result))
+        sys.stdout.flush()
+    return (report)
+
+
+def _line(r):
+    if "error" in r:
+        return ("%-18s %-7s %9d  ERROR %s" % (r["stage"], r["scale"], r["ensembles"], r["error"]))
+    return ("%-18s %-7s %9d %9.3f %9.3f %12.0f %9.1f" % (r["stage"], r["scale"], r["ensembles"], r["wall_s"],
+                                                         r["cpu_s"], r["rows_per_s"], r["peak_rss_mb"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark the adcp pipeline on synthetic deployments")
+    parser.add_argument("--lake", default="OWS", choices=["SKN", "OWS", "SEN"])
+    parser.add_argument("--scales", nargs="+", default=["day", "week", "month"], choices=list(SCALES))
+    parser.add_argument("--files", type=int, default=4, help="raw files per deployment")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES))
+    parser.add_argument("--interval", default="5min", help="time between ensembles")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None, help="keep the generated data here instead of a temp dir")
+    parser.add_argument("--json", default=None, help="write the report to this file")
+    args = parser.parse_args()
+
+    print("%-18s %-7s %9s %9s %9s %12s %9s" % ("stage", "scale", "ensembles", "wall_s", "cpu_s", "rows/s", "rss_mb"))
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = args.work_dir or tmp
+        report = []
+        for scale in args.scales:
+            report += run_scale(args.lake, scale, args.files, args.stages, work_dir, args.seed, args.interval)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=1)
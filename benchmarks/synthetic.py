@@ -0,0 +1,159 @@
+""" Seeded generator of synthetic adcp deployments for benchmarking the pipeline
+
+Writes PD0 raw files that tables.reader.read_pd0 decodes, laid out the way backscatter.auto_mb
+expects them (raw_dir/<year>/<ID><nnn>r.000), plus a matching flx temperature sensor table
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+# bins per lake as deployed: Skaneateles, Owasco, Seneca
+LAKE_BINS = {"SKN": 26, "OWS": 28, "SEN": 30}
+
+BEAMS = 4
+# fixed leader, variable leader, velocity, correlation, echo intensity, percent good
+N_TYPES = 6
+FIXED_LEN, VARIABLE_LEN = 59, 65
+
+
+def _layout(n_bins):
+    """offsets of the data types in one ensemble and its length without the checksum"""
+    sizes = [FIXED_LEN, VARIABLE_LEN, 2 + 2*n_bins*BEAMS, 2 + n_bins*BEAMS, 2 + n_bins*BEAMS, 2 + n_bins*BEAMS]
+    offsets = 6 + 2*N_TYPES + np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    return (offsets, int(6 + 2*N_TYPES + sum(sizes)))
+
+
+def _put16(ens, at, values):
+    values = np.asarray(values).astype(np.int64) & 0xFFFF
+    ens[:, at] = values & 0xFF
+    ens[:, at+1] = values >> 8
+
+
+def ensembles(time, n_bins, rng, cell_cm=100, bin1_cm=161):
+    """ Encode one PD0 ensemble per timestamp
+
+    Parameters
+    ----------
+    time : DatetimeIndex
+        ensemble times
+    n_bins : int
+        number of depth cells
+    rng : np.random.Generator
+        seeded generator for the measurements
+
+    Returns
+    -------
+    bytes
+        the encoded ensembles, back to back
+    """
+    n = len(time)
+    offsets, length = _layout(n_bins)
+    ens = np.zeros((n, length + 2), dtype=np.uint8)
+
+    # ---- header and offset table
+    ens[:, 0:2] = 0x7F
+    _put16(ens, 2, np.full(n, length))
+    ens[:, 5] = N_TYPES
+    for k, off in enumerate(offsets):
+        _put16(ens, 6 + 2*k, np.full(n, off))
+    for off, code in zip(offsets, (0x0000, 0x0080, 0x0100, 0x0200, 0x0300, 0x0400)):
+        _put16(ens, off, np.full(n, code))
+
+    # ---- fixed leader
+    fixed = offsets[0]
+    ens[:, fixed+8], ens[:, fixed+9] = BEAMS, n_bins
+    _put16(ens, fixed+12, np.full(n, cell_cm))
+    _put16(ens, fixed+32, np.full(n, bin1_cm))
+
+    # ---- variable leader: clock, attitude, a seasonal and diurnal water temperature, ADC counts
+    var = offsets[1]
+    _put16(ens, var+2, np.arange(n))
+    for k, x in enumerate((time.year % 100, time.month, time.day, time.hour, time.minute, time.second)):
+        ens[:, var+4+k] = np.asarray(x)
+    day = np.asarray(time.dayofyear + time.hour/24, dtype=float)
+    temp = 12 + 8*np.sin(2*np.pi*(day - 100)/365) + 0.8*np.sin(2*np.pi*day) + rng.normal(0, 0.1, n)
+    _put16(ens, var+18, rng.uniform(0, 36000, n))
+    _put16(ens, var+20, rng.normal(0, 150, n))
+    _put16(ens, var+22, rng.normal(0, 150, n))
+    _put16(ens, var+26, np.round(temp*100))
+    ens[:, var+34] = rng.integers(100, 140, n)
+    ens[:, var+35] = rng.integers(130, 160, n)
+    ens[:, var+36] = rng.integers(95, 110, n)
+    ens[:, var+39] = rng.integers(100, 120, n)
+
+    # ---- profiles: echo intensity falls off with range, the rest is noise around plausible levels
+    cells = n_bins*BEAMS
+    vel = rng.normal(0, 150, (n, cells)).astype(np.int16)
+    ens[:, offsets[2]+2:offsets[2]+2+2*cells] = vel.astype("<i2").view(np.uint8).reshape(n, -1)
+    echo = 180 - 3.5*np.repeat(np.arange(n_bins), BEAMS) + rng.normal(0, 4, (n, cells))
+    ens[:, offsets[4]+2:offsets[4]+2+cells] = np.clip(echo, 0, 255)
+    ens[:, offsets[3]+2:offsets[3]+2+cells] = rng.integers(90, 128, (n, cells))
+    ens[:, offsets[5]+2:offsets[5]+2+cells] = rng.integers(80, 101, (n, cells))
+
+    # ---- checksum over everything before it
+    _put16(ens, length, ens[:, :length].sum(axis=1, dtype=np.uint32))
+    return (ens.tobytes())
+
+
+def deployment(raw_dir, lake="OWS", year=2019, days=1, files=1, interval="5min", seed=0, start=None):
+    """ Write a synthetic deployment of one lake-year split over several raw files
+
+    Parameters
+    ----------
+    raw_dir : str
+        raw data root; files land in raw_dir/<year>/<ID><nnn>r.000
+    lake : str
+        SKN, OWS or SEN; picks the number of bins
+    year : int
+    days : float
+        length of the deployment
+    files : int
+        number of raw files the deployment is split into
+    interval : str
+        time between ensembles
+    seed : int
+
+    Returns
+    -------
+    tuple
+        experiment id (ex: OWS19) and the list of raw files written
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start or str(year) + "-06-01")
+    time = pd.date_range(start, start + pd.Timedelta(days=days), freq=interval, inclusive="left")
+    eyedee = lake + str(year)[-2:]
+    out = os.path.join(raw_dir, str(year))
+    os.makedirs(out, exist_ok=True)
+
+    paths = []
+    for k, part in enumerate(np.array_split(np.arange(len(time)), files)):
+        path = os.path.join(out, eyedee + str(k).zfill(3) + "r.000")
+        with open(path, "wb") as f:
+            # one day at a time keeps the encoder's working memory small for multi-year runs
+            for x in np.array_split(part, max(1, len(part) // 2000)):
+                f.write(ensembles(time[x], LAKE_BINS[lake], rng))
+        paths.append(path)
+    return (eyedee, paths)
+
+
+def flx_table(lake="OWS", year=2019, days=1, depths=range(1, 26), interval="15min", seed=0, start=None):
+    """ Synthetic flx sensor string readings matching a deployment from `deployment`
+
+    Returns
+    -------
+    dataframe
+        Timestamp_EST, Temperature_C, Depth_m and Site, like flx_most_recent.csv
+    """
+    rng = np.random.default_rng(seed + 1)
+    start = pd.Timestamp(start or str(year) + "-06-01")
+    time = pd.date_range(start, start + pd.Timedelta(days=days), freq=interval, inclusive="left")
+    depths = np.asarray(list(depths))
+    t = np.repeat(time, len(depths))
+    d = np.tile(depths, len(time))
+    day = np.asarray(t.dayofyear + t.hour/24, dtype=float)
+    # warm epilimnion over a cold hypolimnion, thermocline near 10 m
+    surface = 12 + 8*np.sin(2*np.pi*(day - 100)/365) + 0.8*np.sin(2*np.pi*day)
+    temp = 6 + (surface - 6)/(1 + np.exp((d - 10)/2)) + rng.normal(0, 0.1, len(t))
+    return (pd.DataFrame({"Timestamp_EST": t.strftime("%Y-%m-%d %H:%M:%S"), "Temperature_C": temp,
+                          "Depth_m": d, "Site": lake}))
@@ -1,28 +1,29 @@
+import os
+import sys
 import glob
 import pandas as pd
 
+# run from anywhere: the tables package sits one level up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tables.burst import burst_files
+
 ############################################################################
 #### Burst averaging function for Sen18 data
 ############################################################################
-def sen18_repair(pull_dir, push_dir):
+def sen18_repair(pull_dir, push_dir, workers=1):
     """Takes in each full Seneca 2018 table, burst averages every 15 minutes
 
+    Tables are streamed in chunks by tables.burst, the output matches
+    df.resample('15T', on='time', label='right', closed='right', origin='start').mean()
+
     Args:
         pull_dir (str): directory where data is stored
         push_dir (str): directory where data is going
+        workers (int): tables averaged at once
 
     """
- 
-    for x in glob.glob(pull_dir + "SEN18_*.csv"):
-        # catch the end of the string to paste on the new file 
-        y = x.rsplit('/')[-1]
-
-        df = pd.read_csv(x)
-        df['time'] = pd.to_datetime(df['time']) 
-        # df = df.iloc[:-38] 
-
-        rsmp = df.resample('15T', on ='time', label='right', closed='right', origin='start').mean()
-        rsmp.to_csv(push_dir + "avgd_"+ y)
+    files = [x for x in glob.glob(pull_dir + "SEN18_*.csv") if not x.endswith("_table_bins.csv")]
+    return(burst_files(files, push_dir, "15min", prefix="avgd_", workers=workers))
 
 ############################################################################
 #### Function for checking on results of averaging
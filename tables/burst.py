@@ -0,0 +1,148 @@
+""" Burst average time ordered tables into fixed intervals, chunk by chunk
+
+Equivalent to df.resample(interval, on="time", label="right", closed="right", origin="start").mean()
+for any lake-year table, without loading it: rows are streamed in chunks, each timestamp gets its bin
+by integer arithmetic on int64 ns, sums and counts are reduced per bin and the bin still open at the
+end of a chunk is carried into the next one. Memory is bounded by the chunk size.
+"""
+
+import os
+import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+
+from tables.storage import FORMATS, iter_table, write_chunks
+
+
+def _bursts(chunks, interval, sort_key):
+    """yield the burst averaged rows of a stream of time ordered chunks"""
+    step = pd.Timedelta(interval).value
+    origin = cols = None
+    # bin still open at the end of the previous chunk: label index, sums, counts
+    carry = None
+    last_k = last_t = None
+
+    def emit(ks, sums, counts):
+        """rows for bins ks, with the empty bins between consecutive ones like resample"""
+        nonlocal last_k
+        first = ks[0] if last_k is None else last_k + 1
+        full = np.arange(first, ks[-1] + 1)
+        mean = np.full((len(full), len(cols)), np.nan)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean[ks - first] = np.where(counts > 0, sums / counts, np.nan)
+        last_k = ks[-1]
+        df = pd.DataFrame(mean, columns=cols)
+        df.insert(0, sort_key, pd.to_datetime(origin + full * step))
+        return (df)
+
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        t = pd.to_datetime(chunk[sort_key]).to_numpy().astype("datetime64[ns]").astype(np.int64)
+        if cols is None:
+            cols = [x for x in chunk.columns if x != sort_key]
+            origin = int(t[0])
+        if np.any(t[1:] < t[:-1]) or (last_t is not None and t[0] < last_t):
+            raise ValueError("burst averaging needs a table in time order")
+        last_t = t[-1]
+
+        # closed and labelled right: a time on a bin edge belongs to the bin it ends
+        k = -((origin - t) // step)
+        values = chunk[cols].to_numpy(dtype=float)
+        ok = np.isfinite(values)
+        starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+        ks = k[starts]
+        sums = np.add.reduceat(np.where(ok, values, 0), starts, axis=0)
+        counts = np.add.reduceat(ok.astype(np.int64), starts, axis=0)
+
+        if carry is not None:
+            if ks[0] == carry[0]:
+                sums[0] += carry[1]
+                counts[0] += carry[2]
+            else:
+                ks, sums, counts = np.r_[carry[0], ks], np.vstack([carry[1], sums]), np.vstack([carry[2], counts])
+        # the last bin may go on in the next chunk
+        carry = (ks[-1], sums[-1], counts[-1])
+        if len(ks) > 1:
+            yield (emit(ks[:-1], sums[:-1], counts[:-1]))
+
+    if carry is not None:
+        yield (emit(np.array([carry[0]]), carry[1][None], carry[2][None]))
+
+
+def burst_average(path, out_path, interval="15min", sort_key="time", chunksize=200000):
+    """ Burst average one table
+
+    Parameters
+    ----------
+    path : str
+        time ordered table, .csv, .parquet or .feather, ex: .../SEN18/SEN18_amp_avg.csv
+    out_path : str
+        destination, its extension picks the format
+    interval : str
+        burst length, ex: "15min", "1h"
+    sort_key : str
+        time column
+    chunksize : int
+        rows read at once
+
+    Returns
+    -------
+    int
+        number of bursts written
+    """
+    # averages are never counts: a category outside the count tables keeps every column float
+    return (write_chunks(_bursts(iter_table(path, chunksize), interval, sort_key), out_path, "burst"))
+
+
+def burst_files(files, out_dir, interval="15min", prefix="avgd_", workers=1, fmt=None, chunksize=200000):
+    """ Burst average many tables, all categories of a lake-year at once across a process pool
+
+    files: tables to average; those without a time column, like table_bins, are reported as failed
+    out_dir: output directory, each table goes to out_dir/<prefix><file name>
+    fmt: output format, the one of each input by default
+    Returns a dict of failed file: error
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = {}
+    for x in files:
+        name = os.path.basename(x)
+        if fmt is not None:
+            name = os.path.splitext(name)[0] + FORMATS[fmt]
+        jobs[x] = os.path.join(out_dir, prefix + name)
+
+    failed = {}
+
+    def report(k, file, error):
+        if error is None:
+            print("[" + str(k) + "/" + str(len(jobs)) + "] averaged " + file)
+        else:
+            failed[file] = error
+            print("[" + str(k) + "/" + str(len(jobs)) + "] FAILED " + file + ": " + repr(error))
+
+    if workers <= 1:
+        for k, (x, out) in enumerate(jobs.items(), 1):
+            try:
+                burst_average(x, out, interval, chunksize=chunksize)
+                report(k, x, None)
+            except Exception as error:
+                report(k, x, error)
+        return (failed)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(burst_average, x, out, interval, "time", chunksize): x for x, out in jobs.items()}
+        for k, job in enumerate(as_completed(futures), 1):
+            try:
+                job.result()
+                report(k, futures[job], None)
+            except Exception as error:
+                report(k, futures[job], error)
+    return (failed)
+
+
+def burst_lake(eyedee, stacked_dir, out_dir, interval="15min", fmt="csv", workers=os.cpu_count()):
+    """Burst average every stacked table of a lake-year, ex: burst_lake("SEN18", ".../adcp_tables_stacked/", ...)"""
+    files = sorted(glob.glob(stacked_dir + eyedee + "/" + eyedee + "_*" + FORMATS[fmt]))
+    files = [x for x in files if not x.endswith("_table_bins" + FORMATS[fmt])]
+    return (burst_files(files, out_dir, interval, workers=workers))
@@ -2,11 +2,18 @@
 
 """
 
+import os
+import json
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import glob
 
-def aggr_df(lake_id, category, dir1, dir2, sort_key="time", pth=False): 
+from tables.storage import (FORMATS, apply_schema, index_table, iter_table, read_table, table_format, write_chunks,
+                            write_table)
+
+def aggr_df(lake_id, category, dir1, dir2, sort_key="time", pth=False, fmt="csv", writer=None, incremental=False,
+            budget=None, compact=False, dedupe=None): 
     """ Takes in csv's for a lake and category and returns a stacked table
      
     Parameters
@@ -18,7 +25,7 @@ def aggr_df(lake_id, category, dir1, dir2, sort_key="time", pth=False):
     dir1 : str
         directory where the separated data tables are located
     dir2 : str
-        directory where the stacked data tables will end up
+        directory where the stacked data tables will end up, None to keep the table in memory only
     format examples: 
         dir1 = "adcp_habs/data/adcp_data_tables/"
         dir2 = "/home/mpoe/adcp_habs/data/adcp_tables_stacked/"
@@ -26,47 +33,326 @@ def aggr_df(lake_id, category, dir1, dir2, sort_key="time", pth=False):
         default sorting by time
     pth : boolean
         set to True for use with Denali or if trouble with remote server
-
+    fmt : str
+        "csv", "parquet" or "feather"; storage format of the separated and stacked tables
+    writer : tables.storage.TableWriter
+        optional background writer, the stacked table is handed to it instead of written in line
+    incremental : boolean
+        only read separated tables that are new or changed since the last run, see aggr_incremental;
+        the update is written in line, writer is not used, and only the added rows are returned
+    budget : int
+        rows held in memory at once while stacking; when set with dir2 the time ordered inputs are
+        merged straight to disk by merge_sorted and only the number of rows is returned, so memory
+        stays near budget rows instead of the inputs, their concatenation and its sort
+    compact : boolean
+        cast every separated table to the compact schema of tables.storage as it is read:
+        uint8 counts, float32 values and datetime64 time
+    dedupe : boolean
+        keep only the first row of each sort key, dropping the ensembles repeated where deployment
+        files overlap; on by default with budget, off otherwise; not applied in incremental mode
 
     Returns
     -------
-    csv
-        one large table written to a new file and read back in
+    dataframe
+        one large table, also written to a new file when dir2 is given
+        in incremental mode only the rows added by this call
+    int
+        rows written, instead of the table, with budget and dir2
     """
     
     # directory business
-    file_directory = dir1 + lake_id + "*/*" + category + "*.csv"
-    pt_dir = dir2 + lake_id
-    pt_file = pt_dir + "/" + lake_id + "_" + category + ".csv"
-    # define in pathlib format and write the directory if not exist
-    point_directory = Path.home()/Path(pt_dir)
-    point_directory.mkdir(parents=True, exist_ok=True)
+    files = inputs(lake_id, category, dir1, fmt=fmt, pth=pth)
+
+    if dir2 is not None:
+        pt_dir = dir2 + lake_id
+        pt_file = pt_dir + "/" + lake_id + "_" + category + FORMATS[fmt]
+        # define in pathlib format and write the directory if not exist
+        point_directory = Path.home()/Path(pt_dir)
+        point_directory.mkdir(parents=True, exist_ok=True)
+        if incremental and os.path.exists(pt_file) and os.path.exists(_manifest_path(pt_file)):
+            return (aggr_incremental(files, pt_file, category, sort_key, compact))
+        if budget is not None:
+            dedupe = True if dedupe is None else dedupe
+            return (merge_sorted(files, pt_file, category, sort_key, budget=budget, dedupe=dedupe, compact=compact))
 
     # pull the files and create list of df's
-    df_list = []
+    df_list = [read_table(file_path) for file_path in files]
+    if compact:
+        df_list = [apply_schema(df, category) for df in df_list]
+
+    # stack df's into one table and sort by time
+    concat_df = _stack(df_list, sort_key)
+    if dedupe:
+        concat_df = concat_df.drop_duplicates(sort_key, keep="first", ignore_index=True)
+
+    # persist the stacked table; the in-memory frame is what gets returned
+    if dir2 is not None:
+        manifest = {"sort_key": sort_key, "inputs": {}}
+        for file_path, df in zip(files, df_list):
+            manifest["inputs"][file_path] = _entry(file_path, df, sort_key)
+        if writer is None:
+            write_table(concat_df, pt_file, category)
+            _finish(pt_file, manifest)
+        else:
+            # the manifest only describes a table that made it to disk
+            def saved(job):
+                if job.exception() is None:
+                    _finish(pt_file, manifest)
+            writer.submit(concat_df, pt_file, category).add_done_callback(saved)
+
+    return (concat_df)
+
+
+def inputs(lake_id, category, dir1, fmt="csv", pth=False):
+    """separated tables of one lake and category that aggr_df stacks, see aggr_df for the parameters"""
+    file_directory = dir1 + lake_id + "*/*" + category + "*" + FORMATS[fmt]
     if pth:
-        for file_path in Path.home().glob(file_directory):
-            indiv_csv = pd.read_csv(file_path)
-            df_list.append(indiv_csv)
+        return ([str(x) for x in Path.home().glob(file_directory)])
+    return (glob.glob(file_directory))
+
+
+def aggr_incremental(files, pt_file, category, sort_key="time", compact=False):
+    """ Merge new or changed separated tables into an existing stacked table
+
+    The manifest next to the stacked table records path, size, mtime and time range of every input.
+    Only inputs missing from it or whose size or mtime changed are read. When nothing changed and the
+    new rows all come after the end of a csv stack they are appended without reading the stack; any
+    other update reads the stack, drops the old rows of changed inputs and merges. Rows are dropped by
+    the recorded key range of the changed input, so a removed input, or a changed one whose range
+    overlaps the range of another input, forces a full rebuild instead.
+
+    Parameters
+    ----------
+    files : list
+        separated tables for one lake and category
+    pt_file : str
+        stacked table, with its manifest at pt_file + ".manifest.json"
+    category : str
+        table suffix, amp_avg, table_time_series...
+    sort_key : str
+        default sorting by time
+    compact : boolean
+        cast the tables read to the compact schema, see aggr_df
+
+    Returns
+    -------
+    dataframe
+        rows added to the stacked table, empty when everything was up to date; the whole table
+        after a full rebuild
+    """
+    manifest = _load_manifest(pt_file)
+    known = manifest["inputs"]
+
+    fresh, changed, entries = [], [], {}
+    for file_path in files:
+        st = os.stat(file_path)
+        old = known.get(file_path)
+        if old is not None and old["size"] == st.st_size and old["mtime"] == st.st_mtime_ns:
+            continue
+        if old is not None:
+            changed.append(file_path)
+        fresh.append(file_path)
+
+    if set(known) - set(files) or any(_overlaps(known, x, sort_key) for x in changed):
+        return (_rebuild(files, pt_file, category, sort_key, compact))
+    if not fresh:
+        return (pd.DataFrame())
+
+    df_list = [_read(x, category, compact) for x in fresh]
+    for file_path, df in zip(fresh, df_list):
+        entries[file_path] = _entry(file_path, df, sort_key)
+
+    fresh_df = _stack(df_list, sort_key)
+    stack_end = max((_key(x["end"], sort_key) for x in known.values()), default=None)
+    first = _key(fresh_df[sort_key].iloc[0], sort_key)
+
+    if not changed and table_format(pt_file) == "csv" and stack_end is not None and first > stack_end:
+        # pure append: the new rows go on the end of the csv without touching what is there
+        fresh_df.columns = pd.read_csv(pt_file, nrows=0).columns
+        fresh_df.to_csv(pt_file, mode="a", header=False, index=False)
     else:
-        for file_path in glob.glob(file_directory):
-            indiv_csv = pd.read_csv(file_path)
-            df_list.append(indiv_csv)
+        stack = _read(pt_file, category, compact)
+        keys = _key(stack[sort_key], sort_key)
+        stale = pd.Series(False, index=stack.index)
+        # no other input has keys in the range of a changed one, checked above
+        for x in changed:
+            stale |= (keys >= _key(known[x]["start"], sort_key)) & (keys <= _key(known[x]["end"], sort_key))
+        stack = stack[~stale]
+        fresh_df.columns = stack.columns
+        write_table(_stack([stack, fresh_df], sort_key), pt_file, category)
+
+    known.update(entries)
+    _finish(pt_file, manifest)
+    return (fresh_df)
+
+
+def merge_sorted(files, pt_file, category=None, sort_key="time", budget=1000000, dedupe=False, compact=False):
+    """ Out of core k-way merge of separated tables that are each already sorted
+
+    Every input is read in chunks of budget // len(files) rows. Rows up to the smallest last key
+    among the loaded chunks are safe to emit, so they are merged, written and released, and the
+    drained input reads its next chunk. Memory stays near budget rows however many inputs exist.
+    Equal keys keep the order of files, like aggr_df. The manifest and sidecar index of the stacked
+    table are written as aggr_df does, so a later incremental aggr_df picks up from it.
+
+    Parameters
+    ----------
+    files : list
+        separated tables for one lake and category, each sorted by sort_key
+    pt_file : str
+        stacked table written chunk by chunk; .csv, .parquet or .feather
+    category : str
+        table suffix, amp_avg, table_time_series...; picks the schema of columnar formats and of
+        compact, required with compact
+    sort_key : str
+        default merging by time
+    budget : int
+        rows held in memory across all inputs
+    dedupe : boolean
+        keep only the first row of each key, for ensembles repeated where deployment files overlap
+    compact : boolean
+        cast every chunk to the compact schema of the category as it is read, see aggr_df
+
+    Returns
+    -------
+    int
+        rows written; nothing is written, not even the manifest, when the inputs hold no rows
+    """
+    chunksize = max(1, budget // max(1, len(files)))
+    readers = [iter_table(x, chunksize) for x in files]
+    cols = []
+    # first and last key of every input, for the manifest
+    ranges = {}
+
+    def pull(head):
+        """load the next non empty chunk of an input, False once it is exhausted"""
+        for df in head[0]:
+            if len(df):
+                if compact:
+                    df = apply_schema(df, category)
+                if len(cols) == 0:
+                    cols.extend(df.columns)
+                # change all dfs to have matching column names
+                df.columns = cols
+                head[1], head[2] = df, _key(df[sort_key], sort_key).to_numpy()
+                ranges.setdefault(head[3], [df[sort_key].iloc[0], None])[1] = df[sort_key].iloc[-1]
+                return (True)
+        return (False)
+
+    def merged():
+        # one [reader, chunk, chunk keys, file] per input that still has rows
+        heads = [x for x in ([r, None, None, f] for r, f in zip(readers, files)) if pull(x)]
+        last = None
+        while heads:
+            # everything at or below the smallest chunk end can not be preceded by unread rows
+            mark = min(x[2][-1] for x in heads)
+            out = []
+            for head in heads:
+                n = np.searchsorted(head[2], mark, side="right")
+                out.append(head[1].iloc[:n])
+                head[1], head[2] = head[1].iloc[n:], head[2][n:]
+            batch = pd.concat(out, ignore_index=True)
+            keys = _key(batch[sort_key], sort_key).to_numpy()
+            order = np.argsort(keys, kind="stable")
+            batch, keys = batch.iloc[order], keys[order]
+            if dedupe:
+                keep = np.ones(len(keys), dtype=bool)
+                keep[1:] = keys[1:] != keys[:-1]
+                if last is not None:
+                    keep &= keys > last
+                batch, keys = batch[keep], keys[keep]
+            if len(keys):
+                last = keys[-1]
+                yield (batch)
 
+            # refill the drained inputs
+            heads = [x for x in heads if len(x[2]) or pull(x)]
+
+    rows = write_chunks(merged(), pt_file, category)
+    if rows == 0:
+        return (rows)
+    manifest = {"sort_key": sort_key, "inputs": {}}
+    for file_path, (start, end) in ranges.items():
+        manifest["inputs"][file_path] = _record(file_path, start, end, sort_key)
+    _finish(pt_file, manifest)
+    return (rows)
+
+
+def _stack(df_list, sort_key):
+    """stack df's into one table and sort by time; the inputs keep their order for equal keys"""
     # change all dfs in list to have matching column names
     cols = df_list[0].columns
     for i in df_list:
         i.columns = cols
-
-    # stack df's into one table and sort by time
     concat_df = pd.concat(df_list, ignore_index=True)
-    concat_df = concat_df.sort_values(sort_key, ascending=True) 
+    return (concat_df.sort_values(sort_key, ascending=True, ignore_index=True, kind="stable"))
+
+
+def _key(x, sort_key):
+    """comparable values of the sort key; times are stored as text in csv's and manifests"""
+    if sort_key == "time":
+        return (pd.to_datetime(x))
+    return (pd.to_numeric(x))
+
+
+def _entry(file_path, df, sort_key):
+    """manifest record of one separated table"""
+    keys = df[sort_key]
+    return (_record(file_path, keys.min(), keys.max(), sort_key))
+
+
+def _record(file_path, start, end, sort_key):
+    """manifest record of a separated table from its smallest and largest key"""
+    st = os.stat(file_path)
+    if sort_key == "time":
+        start, end = str(start), str(end)
+    else:
+        start, end = float(start), float(end)
+    return ({"size": st.st_size, "mtime": st.st_mtime_ns, "start": start, "end": end})
+
+
+def _overlaps(known, file_path, sort_key):
+    """the recorded key range of an input meets the range of any other input"""
+    lo, hi = _key(known[file_path]["start"], sort_key), _key(known[file_path]["end"], sort_key)
+    return (any(_key(x["start"], sort_key) <= hi and lo <= _key(x["end"], sort_key)
+                for k, x in known.items() if k != file_path))
+
+
+def _read(file_path, category, compact):
+    df = read_table(file_path)
+    return (apply_schema(df, category) if compact else df)
+
+
+def _rebuild(files, pt_file, category, sort_key, compact):
+    """stack every input again and write the table and a fresh manifest"""
+    df_list = [_read(x, category, compact) for x in files]
+    manifest = {"sort_key": sort_key, "inputs": {}}
+    for file_path, df in zip(files, df_list):
+        manifest["inputs"][file_path] = _entry(file_path, df, sort_key)
+    df = _stack(df_list, sort_key)
+    write_table(df, pt_file, category)
+    _finish(pt_file, manifest)
+    return (df)
+
+
+def _finish(pt_file, manifest):
+    """the stacked table is on disk: record its inputs and refresh the sidecar index of a csv stack"""
+    _save_manifest(pt_file, manifest)
+    index_table(pt_file, manifest["sort_key"])
+
+
+def _manifest_path(pt_file):
+    return (pt_file + ".manifest.json")
+
+
+def _load_manifest(pt_file):
+    with open(_manifest_path(pt_file)) as f:
+        return (json.load(f))
 
-    # write df as csv to disk and read back in
-    concat_df.to_csv(pt_file, index=False)
-    csv_read = pd.read_csv(pt_file)
 
-    return (csv_read)
+def _save_manifest(pt_file, manifest):
+    with open(_manifest_path(pt_file), "w") as f:
+        json.dump(manifest, f, indent=1)
 
 ################################################################################################
 if __name__ =='__main__':
@@ -1,23 +1,42 @@
 """ Converts time series raw data into ascii and generates backscatter tables """
 
 import os 
+import numpy as np
 import pandas as pd
 import glob
 
 from temp_module import tempmb
 from temp_module.constants import *
+from temp_module.geometry import bin_geometry
+from tables.storage import index_table, read_table, write_table
+
+
+def _persist(df, pt_dir, writer):
+    """Write a finished table unless pt_dir is None, on the background writer when one is given
+    csv tables get a sidecar time index for window reads, see tables.storage.read_window"""
+    if pt_dir is None:
+        return
+    if writer is None:
+        write_table(df, pt_dir)
+        index_table(pt_dir)
+    else:
+        def saved(job):
+            if job.exception() is None:
+                index_table(pt_dir)
+        writer.submit(df, pt_dir).add_done_callback(saved)
 
 
 # Time series converted table build
-def tec(df1, pt_dir):
+def tec(df1, pt_dir=None, writer=None):
     """Takes time series table and array of amplitude tables to convert to backscatter tables"""
     t, tamb, tatt, xii, xvv = (df1["temp"], df1["ambient_T"], df1["attitude_T"], df1["xmit_i"], df1["xmit_v"])
 
-    tmb = tempmb.TempMb(0, 0, t, tatt, tamb)
+    tmb = tempmb.TempMb(0, 0, t.astype(float), tatt.astype(float), tamb.astype(float))
     x = tmb.c_amp_scale()
     y = tmb.attitude_temp()
 
-    xmb = tempmb.Xmit(xii, xvv)
+    # widen compact uint8 counts before they meet float arithmetic
+    xmb = tempmb.Xmit(xii.astype(float), xvv.astype(float))
     xcurr = xmb.xi()
     xvolt = xmb.xv()
 
@@ -25,53 +44,84 @@ def tec(df1, pt_dir):
     dat1 = pd.DataFrame(df_bld_dict)
     dat2 = df1.join(dat1)
 
-    dat2.to_csv(pt_dir, index=False) 
-    g = pd.read_csv(pt_dir)
-    return(g)
+    _persist(dat2, pt_dir, writer)
+    return(dat2)
 
 
 # function version for mb build
-def mb_build(amp_table, df_ts, pt_dir):
-    """Takes time series table and array of amplitude tables to convert to backscatter tables"""
+def mb_build(amp_table, df_ts, pt_dir=None, writer=None, geometry=None, fused=False, dtype=np.float64):
+    """Takes time series table and array of amplitude tables to convert to backscatter tables
+    geometry: optional temp_module.geometry.BinGeometry of the table's bins, shared across beam tables
+    fused: evaluate with tempmb.mb_fused, blockwise into one preallocated output of the given dtype"""
     tmp, tamb, tatt = (df_ts["temp"], df_ts["ambient_T"], df_ts["attitude_T"])
 
-    # loop over amp df and separate each column into series
-    df_mb = []
-    df_mb.append(amp_table['time'])
-
-    for x in amp_table:
-        """Build mb table by operating mb function column by column"""
-        # loop over string-type depths, ignoring time
-        if x.startswith('time'):
-            pass
-        else:
-            dep = float(x)
-            # function to input only amplitude series by depth
-            def tp_mb(y):
-                tm = tempmb.TempMb(dep, y, tmp, tatt, tamb).measured_backscatter()
-                return (tm)
-            
-            # set column as series for processing
-            amp_x = amp_table[x]
-            # run the function on the series
-            mb_series_x = tp_mb(amp_x)
-            # set new series as dataframe component with corresponding headings
-            mb_df_x = pd.Series(mb_series_x, name=x)
-            # add processed mb series to a list
-            df_mb.append(mb_df_x)
+    # string-type depths name every column but time
+    cols = [x for x in amp_table.columns if not x.startswith('time')]
+    dep = [float(x) for x in cols]
+
+    # whole (time, bin) matrix in one broadcast call
+    if fused:
+        mb = tempmb.mb_fused(amp_table[cols].to_numpy(), geometry or bin_geometry(dep), tmp, tatt, tamb, dtype=dtype)
+    else:
+        mb = tempmb.mb_matrix(amp_table[cols].to_numpy(), dep, tmp, tatt, tamb, geometry)
 
     # Build and return mb table 
-    df = pd.concat(df_mb, axis=1)
+    df = pd.DataFrame(mb, columns=cols, index=amp_table.index)
+    df.insert(0, 'time', amp_table['time'])
 
     # apply WR near zone corrections; TODO verify explicitly before using
     # df.iloc[:,1] += 1
     # df.iloc[:,2] += 0.5
 
-    # save tp csv
-    df.to_csv(pt_dir, index=False) 
-    # read csv back in for fun
-    g = pd.read_csv(pt_dir)
-    return (g)
+    # save tp table, format from the extension of pt_dir
+    _persist(df, pt_dir, writer)
+    return (df)
+
+
+def mb_build_beams(amp_tables, df_ts, pt_dirs=None, writer=None, geometry=None, dtype=np.float64):
+    """Batch mb build for several amplitude tables (beam1..4, avg) of the same time series
+    The per ensemble terms are computed once and every beam is evaluated into one (beam, time, bin) array
+
+    Parameters
+    ----------
+    amp_tables : dict
+        beam name: amplitude table, ex: {"beam1": amp_beam1, ..., "avg": amp_avg}
+    df_ts : dataframe
+        stacked time series table matching the rows of every amplitude table
+    pt_dirs : dict
+        beam name: output path of its mb table, beams left out are not written
+    writer : tables.storage.TableWriter
+        optional background writer
+    geometry : temp_module.geometry.BinGeometry
+        bin geometry of the tables, looked up from the column depths when not given
+    dtype : np.float64 or np.float32
+
+    Returns
+    -------
+    dict
+        beam name: mb table
+    """
+    beams = list(amp_tables)
+    first = amp_tables[beams[0]]
+    cols = [x for x in first.columns if not x.startswith('time')]
+    if geometry is None:
+        geometry = bin_geometry([float(x) for x in cols])
+
+    # per ensemble terms are shared by every beam and bin
+    terms = tempmb.ensemble_terms(df_ts["temp"], df_ts["attitude_T"], df_ts["ambient_T"], dtype)
+    mb = np.empty((len(beams), len(first), len(cols)), dtype=dtype)
+    for k, beam in enumerate(beams):
+        tempmb.mb_fused(amp_tables[beam][cols].to_numpy(), geometry, None, None, None, out=mb[k], dtype=dtype,
+                         terms=terms)
+
+    tables = {}
+    for k, beam in enumerate(beams):
+        df = pd.DataFrame(mb[k], columns=cols, index=amp_tables[beam].index, copy=False)
+        df.insert(0, 'time', amp_tables[beam]['time'])
+        if pt_dirs is not None:
+            _persist(df, pt_dirs.get(beam), writer)
+        tables[beam] = df
+    return (tables)
 
 
 ################################################################################################
@@ -83,16 +133,15 @@ if __name__ == '__main__':
     directory = "/home/mpoe/adcp_habs/data/adcp_tables_stacked/" + ident + "/" + ident + "_"
 
     # time series conversion
-    temp_check = pd.read_csv(directory + "table_time_series.csv")
+    temp_check = read_table(directory + "table_time_series.csv")
     pnt_dir1 = directory + "converted_time_series.csv"
     test_ts = tec(temp_check, pnt_dir1)
 
-    # backscatter calculations and table builds
+    # backscatter calculations and table builds, all beams in one batch
     cats = ['beam1', 'beam2', 'beam3', 'beam4', 'avg'] 
-    for i in cats:
-        amp_check = pd.read_csv(directory + "amp_" + i + ".csv") 
-        pnt_dir_mb = directory + "mb_" + i + ".csv"
-        test_df = mb_build(amp_check, temp_check, pnt_dir_mb)
-        # print(len(test_df), '\n' , test_df.iloc[10000, :])
+    amp_check = {i: read_table(directory + "amp_" + i + ".csv") for i in cats}
+    pnt_dir_mb = {i: directory + "mb_" + i + ".csv" for i in cats}
+    test_df = mb_build_beams(amp_check, temp_check, pnt_dir_mb)
+    # print(len(test_df['avg']), '\n' , test_df['avg'].iloc[10000, :])
 
     
\ No newline at end of file
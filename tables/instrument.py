@@ -0,0 +1,220 @@
+""" Stage level instrumentation of the adcp pipeline
+
+Every stage of a run (glob, subset of one raw file, stacking of one category, a background write...)
+is measured for wall and cpu time, rows, bytes read and written and memory, and the run is saved
+as a JSON report next to the output tables. A profiler can be attached to the whole run (cProfile)
+or to every stage (any callable returning a context manager, ex: a pyinstrument or py-spy wrapper).
+"""
+
+import os
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+try:
+    import resource
+except ImportError:
+    # not available on windows, memory is then only reported when tracing
+    resource = None
+
+
+def peak_rss_mb():
+    """High water mark of the resident memory of this process in MB, None where unsupported"""
+    if resource is None:
+        return (None)
+    # ru_maxrss is in kB on linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def rss_mb():
+    """Current resident memory of this process in MB, None where unsupported"""
+    try:
+        with open("/proc/self/statm") as f:
+            return (int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20)
+    except (OSError, ValueError, AttributeError):
+        return (None)
+
+
+class _Sampler(threading.Thread):
+    """Highest resident memory seen while a stage runs, polled from a background thread"""
+
+    def __init__(self, every=0.01):
+        super().__init__(daemon=True)
+        self.every = every
+        self.start_mb = self.peak_mb = rss_mb()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.every):
+            self.peak_mb = max(self.peak_mb, rss_mb())
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.peak_mb = max(self.peak_mb, rss_mb())
+        return (self.peak_mb)
+
+
+def file_bytes(paths):
+    """Total size of the files that exist among paths"""
+    return (sum(os.path.getsize(x) for x in paths if os.path.isfile(x)))
+
+
+@contextmanager
+def measure(name, file=None, rows=None, profiler=None):
+    """ Measure one stage; the yielded record can be filled in by the stage itself
+
+    Parameters
+    ----------
+    name : str
+        stage name, ex: subset, aggr_df, tec, mb_build, write
+    file : str
+        input or output file the stage works on, if any
+    rows : int
+        rows processed, usually set on the record once they are known
+    profiler : callable
+        profiler(name, file) returning a context manager entered around the stage
+
+    Yields
+    ------
+    dict
+        stage, file, rows, bytes_read and bytes_written; wall_s, cpu_s, peak_rss_mb, rss_growth_mb
+        and max_rss_mb are added on exit, traced_peak_mb too when tracemalloc is running.
+        cpu_s is the cpu time of the calling thread so background writes are not counted twice.
+        peak_rss_mb is the highest resident memory during this stage, sampled every 10 ms and
+        exact whenever the stage raises the process high water mark; rss_growth_mb is that peak
+        above the resident memory at the start of the stage; max_rss_mb is the high water mark of
+        the whole process so far
+    """
+    rec = {"stage": name, "file": file, "rows": rows, "bytes_read": 0, "bytes_written": 0}
+    high0 = peak_rss_mb()
+    sampler = _Sampler() if rss_mb() is not None else None
+    if sampler is not None:
+        sampler.start()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    t0, c0 = time.perf_counter(), time.thread_time()
+    try:
+        with (profiler(name, file) if profiler is not None else nullcontext()):
+            yield (rec)
+    except BaseException as error:
+        rec["error"] = repr(error)
+        raise
+    finally:
+        rec["wall_s"] = time.perf_counter() - t0
+        rec["cpu_s"] = time.thread_time() - c0
+        rec["max_rss_mb"] = high = peak_rss_mb()
+        if sampler is not None:
+            peak = sampler.stop()
+            # a new high water mark can only have been reached during this stage
+            if high is not None and high > high0:
+                peak = max(peak, high)
+            rec["peak_rss_mb"] = peak
+            rec["rss_growth_mb"] = peak - sampler.start_mb
+        else:
+            # without /proc only the process high water mark is known
+            rec["peak_rss_mb"] = high
+            rec["rss_growth_mb"] = None if high0 is None else high - high0
+        if tracing:
+            rec["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+
+
+class RunReport():
+    """Collect the stage records of one run and save them as a JSON report
+
+    profiler: None, "cprofile" to profile the whole run into <report>.prof, or a callable
+        profiler(name, file) returning a context manager entered around every stage
+    trace_memory: also track the peak of python and numpy allocations per stage with
+        tracemalloc; exact but slows the run down
+    meta: anything else to record with the run, ex: eyedee, fmt, workers
+
+    Records can be added from the background writer threads, so stage and add are thread safe.
+    """
+
+    def __init__(self, profiler=None, trace_memory=False, **meta):
+        self.meta = meta
+        self.stages = []
+        self._lock = threading.Lock()
+        self._trace = trace_memory
+        self._cprofile = cProfile.Profile() if profiler == "cprofile" else None
+        self.profiler = profiler if callable(profiler) else None
+        self._t0 = self._c0 = self._started = None
+
+    def start(self):
+        self._started = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self._t0, self._c0 = time.perf_counter(), time.process_time()
+        if self._trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self._cprofile is not None:
+            self._cprofile.enable()
+        return (self)
+
+    @contextmanager
+    def stage(self, name, file=None, rows=None):
+        """Measure one stage into the report, see measure"""
+        with measure(name, file, rows, self.profiler) as rec:
+            try:
+                yield (rec)
+            finally:
+                self.add(rec)
+
+    def add(self, rec):
+        """Add a record measured elsewhere, ex: in a worker process"""
+        with self._lock:
+            self.stages.append(rec)
+
+    def summary(self):
+        """Totals per stage name: count, wall_s, cpu_s, rows, bytes and the highest peak memory"""
+        totals = {}
+        with self._lock:
+            stages = list(self.stages)
+        for rec in stages:
+            x = totals.setdefault(rec["stage"], {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "rows": 0,
+                                                 "bytes_read": 0, "bytes_written": 0, "peak_rss_mb": None,
+                                                 "errors": 0})
+            x["count"] += 1
+            x["errors"] += "error" in rec
+            for k in ("wall_s", "cpu_s", "rows", "bytes_read", "bytes_written"):
+                x[k] += rec.get(k) or 0
+            if rec.get("peak_rss_mb") is not None:
+                x["peak_rss_mb"] = max(x["peak_rss_mb"] or 0, rec["peak_rss_mb"])
+        return (totals)
+
+    def save(self, path, **extra):
+        """ Stop the run clock and write the report
+
+        Parameters
+        ----------
+        path : str
+            json file, ex: adcp_tables_stacked/OWS19/OWS19_run_report.json
+        extra :
+            added to the top level of the report, ex: failed files
+
+        Returns
+        -------
+        dict
+            the report as written
+        """
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(os.path.splitext(path)[0] + ".prof")
+        if self._trace and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        report = dict(self.meta)
+        report.update(extra)
+        report.update({
+            "started": self._started, "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "wall_s": None if self._t0 is None else time.perf_counter() - self._t0,
+            "cpu_s": None if self._c0 is None else time.process_time() - self._c0,
+            "peak_rss_mb": peak_rss_mb(),
+            "profile": None if self._cprofile is None else os.path.splitext(path)[0] + ".prof",
+            "totals": self.summary(), "stages": list(self.stages)})
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1, default=str)
+        return (report)
@@ -0,0 +1,284 @@
+""" Content-hash cached DAG of pipeline stages
+
+Every stage declares the files it reads, the stages it depends on and the files it writes. Its cache
+key is a hash of the contents of its input files, the keys of its dependencies, its parameters, its
+version and, when asked for, the values of temp_module.constants. After a stage succeeds its key is
+stamped in the cache directory; a rerun skips every stage whose stamp matches and whose outputs are
+still on disk, so an interrupted run resumes from the first stage that did not finish.
+Bump a stage version whenever the code behind it changes what it writes.
+"""
+
+import os
+import json
+import hashlib
+import numbers
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from temp_module import constants
+from tables.instrument import file_bytes, measure
+
+
+def constants_snapshot():
+    """Current values of every constant in temp_module.constants"""
+    return ({k: v for k, v in sorted(vars(constants).items()) if k.isupper()})
+
+
+class Stage():
+    """One node of the pipeline
+
+    name: unique stage name, ex: subset:OWS19000, aggr_df:amp_avg, mb_build
+    run: callable receiving the values of the dependencies, in order, and writing the outputs; it
+        returns the stage value, or a row count or None to leave the value on disk for load;
+        must be picklable (a module level function or functools.partial) when parallel
+    outputs: files the stage writes, all must exist for a cached stage to be skipped
+    deps: names of the stages whose values run receives
+    files: files read directly, their contents are part of the key; a callable returning them for
+        files created by the dependencies, called once the dependencies have run
+    reads: files read through the dependencies, ex: the stacked tables behind their values; only
+        counted in the bytes read of the report, a list or a callable like files
+    version: stage code version
+    params: anything else changing the outputs, ex: storage format; must be json serializable
+    constants: include temp_module.constants in the key
+    load: callable(outputs) returning the value of a skipped stage, or of a stage whose run
+        returned a row count or None, when a dependent has to run; the value is None without it
+    parallel: run in the process pool of Pipeline.run with the other parallel stages
+    isolate: a failure is recorded and the run carries on, otherwise the error is raised
+    """
+
+    def __init__(self, name, run, outputs, deps=(), files=(), version=1, params=None, constants=False,
+                 load=None, parallel=False, isolate=False, reads=()):
+        self.name = name
+        self.run = run
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.files = files if callable(files) else list(files)
+        self.reads = reads if callable(reads) else list(reads)
+        self.version = version
+        self.params = params
+        self.constants = constants
+        self.load = load
+        self.parallel = parallel
+        self.isolate = isolate
+
+    @property
+    def kind(self):
+        """stage name without its target, ex: aggr_df for aggr_df:amp_avg"""
+        return (self.name.split(":", 1)[0])
+
+
+class Pipeline():
+    """ Stages run in the order they were added, which must list dependencies first
+
+    cache_dir: stamps and the digests of hashed files are kept here, stage names are only unique
+        within one pipeline so each pipeline needs its own, ex: one per lake-year
+    report: optional tables.instrument.RunReport; executed stages are measured into it and
+        skipped ones are recorded with cached set
+    """
+
+    def __init__(self, cache_dir, report=None):
+        self.cache_dir = cache_dir
+        self.report = report
+        self.stages = {}
+        self._keys = {}
+        self._values = {}
+        self._digests = None
+        # stages of each kind that are done, for the [k/N] progress lines
+        self._done = {}
+
+    def add(self, stage):
+        for x in stage.deps:
+            if x not in self.stages:
+                raise ValueError(stage.name + " depends on " + x + " which was not added before it")
+        if stage.name in self.stages:
+            raise ValueError("duplicate stage " + stage.name)
+        self.stages[stage.name] = stage
+        return (stage)
+
+    ######################################################################################
+    # keys and stamps
+    def digest(self, path):
+        """sha256 of a file's contents, remembered by size and mtime so unchanged files are read once"""
+        if self._digests is None:
+            self._digests = self._read_json(self._path("_digests")) or {}
+        st = os.stat(path)
+        seen = self._digests.get(path)
+        if seen is not None and seen[0] == st.st_size and seen[1] == st.st_mtime_ns:
+            return (seen[2])
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 22), b""):
+                h.update(block)
+        self._digests[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+        return (h.hexdigest())
+
+    def key(self, name):
+        """cache key of a stage, see the module docstring"""
+        if name not in self._keys:
+            stage = self.stages[name]
+            blob = {"name": name, "version": stage.version, "params": stage.params,
+                    "files": {x: self.digest(x) for x in _paths(stage.files)},
+                    "deps": {x: self.key(x) for x in stage.deps},
+                    "constants": constants_snapshot() if stage.constants else None}
+            text = json.dumps(blob, sort_keys=True, default=str)
+            self._keys[name] = hashlib.sha256(text.encode()).hexdigest()
+        return (self._keys[name])
+
+    def cached(self, name):
+        """True when the stage finished before with the same key and its outputs are still there"""
+        stamp = self._read_json(self._path(name))
+        if stamp is None or stamp["key"] != self.key(name):
+            return (False)
+        return (all(os.path.isfile(x) and os.path.getsize(x) == n for x, n in stamp["outputs"].items()))
+
+    def _stamp(self, name):
+        outputs = {x: os.path.getsize(x) for x in self.stages[name].outputs}
+        self._write_json(self._path(name), {"key": self.key(name), "outputs": outputs})
+
+    def _path(self, name):
+        return (os.path.join(self.cache_dir, name.replace(":", "_").replace("/", "_") + ".json"))
+
+    @staticmethod
+    def _read_json(path):
+        try:
+            with open(path) as f:
+                return (json.load(f))
+        except (OSError, ValueError):
+            return (None)
+
+    @staticmethod
+    def _write_json(path, obj):
+        # a temporary file of its own per writer, then an atomic rename over the old file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+            json.dump(obj, f, indent=1)
+        os.replace(f.name, path)
+
+    ######################################################################################
+    # execution
+    def value(self, name):
+        """value of a stage, loaded from its outputs when it was skipped"""
+        if name not in self._values:
+            stage = self.stages[name]
+            self._values[name] = stage.load(stage.outputs) if stage.load is not None else None
+        return (self._values[name])
+
+    def run(self, force=False, workers=1):
+        """ Run every stage that is not cached
+
+        Parameters
+        ----------
+        force : boolean
+            ignore the stamps and run everything
+        workers : int
+            processes for the parallel stages
+
+        Returns
+        -------
+        dict
+            status of every stage: "cached", "ran", "failed: <error>" or "ran, not stamped" when a
+            dependency failed so the stage is rerun next time
+        """
+        status = {}
+        batch = []
+        self._done = {}
+        for name, stage in self.stages.items():
+            # a stage's key can hash files its dependencies write, they finish before it is looked at
+            if any(x.name in stage.deps for x in batch):
+                self._flush(batch, status, workers)
+                batch = []
+            if not force and self.cached(name):
+                status[name] = "cached"
+                self._record(stage, cached=True)
+                self._progress(stage, "cached")
+                continue
+            if stage.parallel and workers > 1:
+                batch.append(stage)
+                continue
+            self._flush(batch, status, workers)
+            batch = []
+            self._run(stage, status)
+        self._flush(batch, status, workers)
+        if self._digests is not None:
+            # keep what another run sharing the cache recorded meanwhile
+            digests = self._read_json(self._path("_digests")) or {}
+            digests.update(self._digests)
+            self._write_json(self._path("_digests"), digests)
+        return (status)
+
+    def _run(self, stage, status):
+        rec = None
+        try:
+            args = [self.value(x) for x in stage.deps]
+            with measure(stage.kind, file=stage.name, profiler=None if self.report is None else self.report.profiler) as rec:
+                value = stage.run(*args)
+            self._finish(stage, value, rec, status)
+        except Exception as error:
+            self._fail(stage, error, rec, status)
+            if not stage.isolate:
+                raise
+
+    def _flush(self, batch, status, workers):
+        """run a batch of parallel stages across a process pool"""
+        if not batch:
+            return
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = {pool.submit(_measured, stage.kind, stage.name, stage.run,
+                                [self.value(x) for x in stage.deps]): stage for stage in batch}
+            for job in as_completed(jobs):
+                stage = jobs[job]
+                try:
+                    value, rec = job.result()
+                    self._finish(stage, value, rec, status)
+                except Exception as error:
+                    self._fail(stage, error, None, status)
+                    if not stage.isolate:
+                        raise
+
+    def _finish(self, stage, value, rec, status):
+        # a row count only goes to the report, the value is loaded if a dependent runs
+        if value is not None and not isinstance(value, numbers.Integral):
+            self._values[stage.name] = value
+        rec["rows"] = len(value) if hasattr(value, "__len__") else value if isinstance(value, numbers.Integral) \
+            else None
+        rec["bytes_read"] = file_bytes(_paths(stage.files) + _paths(stage.reads))
+        rec["bytes_written"] = file_bytes(stage.outputs)
+        self._add(rec)
+        if any(status.get(x, "").startswith(("failed", "ran, not")) for x in stage.deps):
+            status[stage.name] = "ran, not stamped"
+        else:
+            self._stamp(stage.name)
+            status[stage.name] = "ran"
+        self._progress(stage, "ran")
+
+    def _fail(self, stage, error, rec, status):
+        status[stage.name] = "failed: " + repr(error)
+        if rec is None:
+            rec = {"stage": stage.kind, "file": stage.name, "error": repr(error)}
+        self._add(rec)
+        self._progress(stage, "FAILED", ": " + repr(error))
+
+    def _progress(self, stage, what, note=""):
+        """print a stage as it is done, numbered among the stages of its kind, ex: [3/12] ran subset:..."""
+        k = self._done[stage.kind] = self._done.get(stage.kind, 0) + 1
+        n = sum(x.kind == stage.kind for x in self.stages.values())
+        print("[" + str(k) + "/" + str(n) + "] " + what + " " + stage.name + note)
+
+    def _record(self, stage, cached):
+        self._add({"stage": stage.kind, "file": stage.name, "cached": cached})
+
+    def _add(self, rec):
+        if self.report is not None:
+            self.report.add(rec)
+
+
+def _paths(files):
+    """file list of a stage, resolving a callable"""
+    return (list(files()) if callable(files) else files)
+
+
+def _measured(kind, name, run, args):
+    """run a stage inside a worker process, measured there"""
+    with measure(kind, file=name) as rec:
+        value = run(*args)
+    return (value, rec)
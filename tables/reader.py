@@ -0,0 +1,210 @@
+""" Read RDI PD0 (.000/.PDO) raw adcp files straight into numpy arrays
+Replaces the oce read.oce call so that no R interpreter is needed to subset raw data
+
+Each ensemble is located by walking the 0x7F7F headers of a memory mapped file, checksums are
+verified in one vectorized pass, and the leader and profile records are gathered with fancy
+indexing into preallocated (time, bin, beam) arrays
+"""
+
+import mmap
+import numpy as np
+
+# data type ids found in the ensemble header offset table
+FIXED_LEADER = 0x0000
+VARIABLE_LEADER = 0x0080
+VELOCITY = 0x0100
+CORRELATION = 0x0200
+ECHO_INTENSITY = 0x0300
+PERCENT_GOOD = 0x0400
+
+# flag used by the instrument for a bad velocity
+BAD_VELOCITY = -32768
+
+# number of ensembles gathered at once, keeps the index arrays small for multi-GB files
+CHUNK = 65536
+
+
+def _ensemble_starts(mm, buf, offset=0, stop=None):
+    """Walk the file header to header and return the start offset of every complete ensemble
+    lying between offset and stop, the end of the file by default, and the offset the walk could not
+    get past: the first header whose ensemble runs beyond stop, or the last bytes too short for one"""
+    n = len(mm) if stop is None else min(stop, len(mm))
+    starts = []
+    cut = None
+    pos = mm.find(b"\x7f\x7f", offset, n)
+    while 0 <= pos and pos + 6 <= n:
+        length = mm[pos+2] | (mm[pos+3] << 8)
+        ntypes = mm[pos+5]
+        # a real header has room for its offset table and a checksum inside the file
+        if length > 6 + 2*ntypes:
+            nxt = pos + length + 2
+            if n < nxt:
+                cut = pos if cut is None else cut
+            # landing on the next header is trusted, anything else must prove itself by checksum
+            elif nxt == n or mm[nxt:nxt+2] == b"\x7f\x7f" or _checksum_ok(buf, np.array([pos]))[0]:
+                starts.append(pos)
+                cut = None
+                pos = nxt
+                continue
+        pos = mm.find(b"\x7f\x7f", pos + 1, n)
+    if cut is None:
+        # a header may still begin in the last byte, or in the bytes of one too short to read
+        cut = pos if 0 <= pos else max(offset, n - 1)
+    return (np.asarray(starts, dtype=np.int64), cut)
+
+
+def _checksum_ok(buf, starts):
+    """Compare the stored checksum of every ensemble against the byte sum, vectorized"""
+    lengths = buf[starts+2].astype(np.int64) | (buf[starts+3].astype(np.int64) << 8)
+    ends = starts + lengths
+    # reduceat over interleaved (start, end) pairs sums each ensemble body
+    lo, hi = starts[0], ends[-1] + 1
+    bounds = np.empty(2*len(starts), dtype=np.int64)
+    bounds[0::2], bounds[1::2] = starts - lo, ends - lo
+    sums = np.add.reduceat(buf[lo:hi], bounds, dtype=np.uint32)[0::2] & 0xFFFF
+    stored = buf[ends].astype(np.uint32) | (buf[ends+1].astype(np.uint32) << 8)
+    return (sums == stored)
+
+
+def _u16(buf, at):
+    return (buf[at].astype(np.uint16) | (buf[at+1].astype(np.uint16) << 8))
+
+
+def _i16(buf, at):
+    return (_u16(buf, at).view(np.int16))
+
+
+def _layout(buf, start):
+    """Map data type id to its offset for the ensemble beginning at start"""
+    ntypes = int(buf[start+5])
+    offsets = _u16(buf, start + 6 + 2*np.arange(ntypes)).astype(np.int64)
+    ids = _u16(buf, start + offsets)
+    return (dict(zip(ids.tolist(), offsets.tolist())))
+
+
+def _layout_groups(buf, starts):
+    """Group ensembles sharing a header so each group decodes together; a file normally holds one"""
+    ntypes = buf[starts+5]
+    for nt in np.unique(ntypes):
+        rows = np.flatnonzero(ntypes == nt)
+        header = buf[starts[rows][:, None] + np.arange(4, 6 + 2*int(nt))]
+        while len(rows):
+            same = (header == header[0]).all(axis=1)
+            yield (rows[same])
+            rows, header = rows[~same], header[~same]
+
+
+class ChecksumError(ValueError):
+    """Every ensemble read failed its checksum; end is the byte offset just past the last of them"""
+
+    def __init__(self, message, end):
+        super().__init__(message)
+        self.end = end
+
+
+class NoEnsembleError(ValueError):
+    """No complete ensemble in the bytes read; end is the byte offset to look from next time, the
+    header of an ensemble running past them or the last bytes that may still begin one"""
+
+    def __init__(self, message, end):
+        super().__init__(message)
+        self.end = end
+
+
+def read_pd0(df_adcp, offset=0, length=None):
+    """ Decode a PD0 file into typed arrays using the field names of the oce adp object
+
+    Parameters
+    ----------
+    df_adcp : str
+        raw data file path, ex: "/home/mpoe/adcp_habs/data/RawDataClean/2019/SEN19280r.000"
+    offset : int
+        byte offset to start looking for ensembles, ex: the end of a previous read of a growing file
+    length : int
+        only decode ensembles ending within length bytes of offset, the rest of the file by default
+
+    Returns
+    -------
+    dict
+        a, q, g : uint8 (time, bin, beam) echo intensity, correlation and percent good counts
+        v : float64 (time, bin, beam) velocity in m/s, bad values as nan
+        distance : float64 (bin,) distance to the middle of each bin in m
+        time : datetime64[ns] (time,)
+        xmitCurrent, xmitVoltage, ambientTemp, attitudeTemp : uint8 (time,) ADC counts
+        roll, pitch, heading, temperature : float64 (time,) degrees and degC
+        end : int, byte offset just past the last complete ensemble, where the next read can start
+    """
+    with open(df_adcp, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = np.frombuffer(mm, dtype=np.uint8)
+
+    starts, cut = _ensemble_starts(mm, buf, offset, None if length is None else offset + length)
+    if len(starts) == 0:
+        raise NoEnsembleError("no PD0 ensembles found in " + str(df_adcp), cut)
+    end = int(starts[-1] + _u16(buf, starts[-1] + 2) + 2)
+    starts = starts[_checksum_ok(buf, starts)]
+    if len(starts) == 0:
+        raise ChecksumError("no PD0 ensembles with a valid checksum in " + str(df_adcp), end)
+
+    # instrument configuration from the first fixed leader
+    fixed = starts[0] + _layout(buf, starts[0])[FIXED_LEADER]
+    nbeams, ncells = int(buf[fixed+8]), int(buf[fixed+9])
+    cell_size, bin1 = int(_u16(buf, fixed+12)), int(_u16(buf, fixed+32))
+    nbins = ncells * nbeams
+
+    n = len(starts)
+    adcp = {
+        "a": np.zeros((n, ncells, nbeams), dtype=np.uint8),
+        "q": np.zeros((n, ncells, nbeams), dtype=np.uint8),
+        "g": np.zeros((n, ncells, nbeams), dtype=np.uint8),
+        "v": np.full((n, ncells, nbeams), np.nan),
+        # bin distances kept in whole cm until the end so column names print cleanly
+        "distance": (bin1 + cell_size*np.arange(ncells)) / 100,
+    }
+    stamp = np.zeros((n, 7), dtype=np.int64)
+    counts = {"xmitCurrent": 34, "xmitVoltage": 35, "ambientTemp": 36, "attitudeTemp": 39}
+    for x in ("heading", "pitch", "roll", "temperature"):
+        adcp[x] = np.full(n, np.nan)
+    for x in counts:
+        adcp[x] = np.zeros(n, dtype=np.uint8)
+
+    for rows in _layout_groups(buf, starts):
+        layout = _layout(buf, starts[rows[0]])
+        fixed = starts[rows[0]] + layout[FIXED_LEADER]
+        if (int(buf[fixed+8]), int(buf[fixed+9])) != (nbeams, ncells):
+            raise ValueError("bin or beam count changes within " + str(df_adcp))
+
+        for c in range(0, len(rows), CHUNK):
+            idx = rows[c:c+CHUNK]
+            s = starts[idx]
+
+            # ---- variable leader: clock, attitude, temperature and ADC channels
+            var = s + layout[VARIABLE_LEADER]
+            stamp[idx] = buf[var[:, None] + np.arange(4, 11)]
+            adcp["heading"][idx] = _u16(buf, var+18) / 100
+            adcp["pitch"][idx] = _i16(buf, var+20) / 100
+            adcp["roll"][idx] = _i16(buf, var+22) / 100
+            adcp["temperature"][idx] = _i16(buf, var+26) / 100
+            for x, at in counts.items():
+                adcp[x][idx] = buf[var+at]
+
+            # ---- profile records, stored cell by cell with the beams innermost
+            if VELOCITY in layout:
+                at = (s + layout[VELOCITY] + 2)[:, None] + 2*np.arange(nbins)
+                vel = _i16(buf, at).reshape(-1, ncells, nbeams)
+                adcp["v"][idx] = np.where(vel == BAD_VELOCITY, np.nan, vel / 1000)
+            for x, code in (("q", CORRELATION), ("a", ECHO_INTENSITY), ("g", PERCENT_GOOD)):
+                if code in layout:
+                    at = (s + layout[code] + 2)[:, None] + np.arange(nbins)
+                    adcp[x][idx] = buf[at].reshape(-1, ncells, nbeams)
+
+    # ---- two digit rtc year follows the oce convention
+    year = np.where(stamp[:, 0] < 50, 2000, 1900) + stamp[:, 0]
+    date = ((year - 1970).astype("datetime64[Y]").astype("datetime64[M]") + (stamp[:, 1] - 1)).astype("datetime64[D]")
+    date = date + (stamp[:, 2] - 1)
+    adcp["time"] = (date.astype("datetime64[ns]") + stamp[:, 3]*np.timedelta64(3600, "s")
+                    + stamp[:, 4]*np.timedelta64(60, "s") + stamp[:, 5]*np.timedelta64(1, "s")
+                    + stamp[:, 6]*np.timedelta64(10, "ms"))
+    adcp["end"] = end
+
+    return (adcp)
@@ -0,0 +1,389 @@
+""" Pluggable table storage for the per-file and stacked adcp tables
+
+Tables can be kept as the legacy wide csv's or as columnar parquet/feather files written with an
+explicit schema: a datetime64 time column, uint8 instrument counts and float32 physical values.
+The columnar formats need pyarrow; csv works with pandas alone.
+"""
+
+import io
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+# storage format: file extension
+FORMATS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+
+# per-beam tables whose values are raw 0-255 counts; the beam averages are not integers
+COUNT_TABLES = ("amp_beam", "corr_bm", "prcnt_good_bm")
+# time series columns holding raw ADC counts
+COUNT_COLUMNS = ("xmit_i", "xmit_v", "attitude_T", "ambient_T")
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError as error:
+        raise ImportError("parquet and feather tables need pyarrow: pip install pyarrow") from error
+    return (pyarrow)
+
+
+def table_format(path):
+    """Storage format from the file extension"""
+    ext = os.path.splitext(str(path))[1]
+    for fmt, x in FORMATS.items():
+        if x == ext:
+            return (fmt)
+    raise ValueError("unknown table format: " + str(path))
+
+
+def schema(category, columns):
+    """ Column dtypes for a table category
+
+    Parameters
+    ----------
+    category : str
+        amp_beam1, corr_avg, table_time_series, mb_avg...; the table suffix
+    columns : list
+        column names of the table
+
+    Returns
+    -------
+    dict
+        column name: numpy dtype
+    """
+    counts = category.startswith(COUNT_TABLES)
+    dtypes = {}
+    for x in columns:
+        if x in ("time", "time_adj"):
+            dtypes[x] = np.dtype("datetime64[ns]")
+        elif x == "bin_depth":
+            # bin depths name the data columns, keep them exact
+            dtypes[x] = np.dtype(np.float64)
+        elif counts or (category.endswith("time_series") and x in COUNT_COLUMNS):
+            dtypes[x] = np.dtype(np.uint8)
+        else:
+            dtypes[x] = np.dtype(np.float32)
+    return (dtypes)
+
+
+def apply_schema(df, category):
+    """Cast a table to the schema of its category"""
+    dtypes = schema(category, df.columns)
+    for x, dt in dtypes.items():
+        if dt.kind == "M":
+            df[x] = pd.to_datetime(df[x])
+    return (df.astype(dtypes))
+
+
+def write_table(df, path, category=None):
+    """ Write a table in the format given by the path extension
+
+    Parameters
+    ----------
+    df : dataframe
+        table to write
+    path : str
+        destination; .csv, .parquet or .feather
+    category : str
+        table suffix used to pick the schema of columnar formats, defaults to the end of the file name
+    """
+    fmt = table_format(path)
+    if fmt == "csv":
+        df.to_csv(path, index=False)
+        return
+
+    tbl = _arrow_table(df, category or _category(path))
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(tbl, path)
+    else:
+        import pyarrow.feather as pf
+        pf.write_feather(tbl, path)
+
+
+def write_chunks(chunks, path, category=None):
+    """ Write a table arriving as a sequence of dataframes without holding more than one in memory
+
+    Parameters
+    ----------
+    chunks : iterable
+        dataframes sharing the same columns, written in order
+    path : str
+        destination; .csv, .parquet or .feather
+    category : str
+        table suffix used to pick the schema of columnar formats, defaults to the end of the file name
+
+    Returns
+    -------
+    int
+        number of rows written
+    """
+    fmt = table_format(path)
+    category = category or _category(path)
+    rows, sink = 0, None
+    try:
+        for df in chunks:
+            if fmt == "csv":
+                df.to_csv(path, index=False, mode="w" if rows == 0 else "a", header=rows == 0)
+            else:
+                tbl = _arrow_table(df, category)
+                if sink is None:
+                    pa = _pyarrow()
+                    if fmt == "parquet":
+                        import pyarrow.parquet as pq
+                        sink = pq.ParquetWriter(path, tbl.schema)
+                    else:
+                        import pyarrow.ipc
+                        sink = pa.ipc.new_file(path, tbl.schema)
+                sink.write_table(tbl)
+            rows += len(df)
+    finally:
+        if sink is not None:
+            sink.close()
+    return (rows)
+
+
+def iter_table(path, chunksize=100000):
+    """Read a table chunk by chunk, yields dataframes of at most chunksize rows"""
+    fmt = table_format(path)
+    if fmt == "csv":
+        yield from pd.read_csv(path, chunksize=chunksize)
+    elif fmt == "parquet":
+        _pyarrow()
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield (batch.to_pandas())
+    else:
+        pa = _pyarrow()
+        import pyarrow.ipc
+        # feather v2 is the arrow ipc file format; memory mapping keeps unread batches on disk
+        with pa.memory_map(str(path)) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                for x in range(0, batch.num_rows, chunksize):
+                    yield (batch.slice(x, chunksize).to_pandas())
+
+
+def read_table(path, columns=None, start=None, end=None, sort_key="time"):
+    """ Read a table, optionally projecting columns and keeping only a time range
+
+    Parameters
+    ----------
+    path : str
+        .csv, .parquet or .feather table
+    columns : list
+        columns to load, all by default; the sort key is always kept for range selection
+    start, end : str or timestamp
+        inclusive time range; parquet pushes it down to the row groups
+    sort_key : str
+        column the time range applies to
+
+    Returns
+    -------
+    dataframe
+    """
+    fmt = table_format(path)
+    if columns is not None and (start is not None or end is not None) and sort_key not in columns:
+        columns = [sort_key] + list(columns)
+
+    filters = []
+    if start is not None:
+        filters.append((sort_key, ">=", pd.Timestamp(start)))
+    if end is not None:
+        filters.append((sort_key, "<=", pd.Timestamp(end)))
+
+    if fmt == "parquet":
+        _pyarrow()
+        import pyarrow.parquet as pq
+        return (pq.read_table(path, columns=columns, filters=filters or None).to_pandas())
+    if fmt == "feather":
+        _pyarrow()
+        import pyarrow.feather as pf
+        df = pf.read_table(path, columns=columns).to_pandas()
+    elif filters and load_index(path, sort_key) is not None:
+        # only the bytes between the index checkpoints around the range are parsed
+        df = read_window(path, start, end, columns, sort_key)
+        df[sort_key] = pd.to_datetime(df[sort_key])
+    else:
+        df = pd.read_csv(path, usecols=columns)
+        if filters:
+            df[sort_key] = pd.to_datetime(df[sort_key])
+
+    for x, op, t in filters:
+        df = df[df[x] >= t] if op == ">=" else df[df[x] <= t]
+    return (df)
+
+
+def index_path(path):
+    return (str(path) + ".idx.json")
+
+
+def index_table(path, sort_key="time", every=2048):
+    """ Write the sidecar index of a sorted csv table: its columns and the byte offset and sort key of
+    every `every`-th row, so read_window can seek to a range instead of parsing the whole file.
+    Other formats carry their own statistics and are left alone.
+
+    Parameters
+    ----------
+    path : str
+        csv table sorted by sort_key, the index goes to path + ".idx.json"
+    sort_key : str
+        column the checkpoints record
+    every : int
+        rows between checkpoints
+
+    Returns
+    -------
+    dict
+        the index, None for a non csv table
+    """
+    if table_format(path) != "csv":
+        return (None)
+    st = os.stat(path)
+    with open(path, "rb") as f:
+        header = f.readline()
+        columns = header.decode().rstrip("\r\n").split(",")
+        pos = columns.index(sort_key)
+
+        # ---- newline positions block by block; row r starts after the r-th newline of the data
+        offsets, rows, base = [len(header)], 0, len(header)
+        while True:
+            block = f.read(1 << 26)
+            if not block:
+                break
+            nl = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+            starts = nl + base + 1
+            rank = rows + 1 + np.arange(len(nl))
+            offsets.extend(starts[rank % every == 0].tolist())
+            rows += len(nl)
+            base += len(block)
+        # a checkpoint at the very end of the file has no row
+        offsets = [x for x in offsets if x < st.st_size]
+
+        keys = []
+        for x in offsets:
+            f.seek(x)
+            keys.append(f.readline().decode().split(",")[pos])
+
+    idx = {"sort_key": sort_key, "columns": columns, "header": len(header), "size": st.st_size, "mtime": st.st_mtime_ns, "rows": rows,
+           "every": every, "offsets": offsets, "keys": keys}
+    with open(index_path(path), "w") as f:
+        json.dump(idx, f)
+    return (idx)
+
+
+def load_index(path, sort_key="time"):
+    """The sidecar index of a csv table, None when missing, built on another key or out of date"""
+    try:
+        with open(index_path(path)) as f:
+            idx = json.load(f)
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return (None)
+    if idx["sort_key"] != sort_key or idx["size"] != st.st_size or idx["mtime"] != st.st_mtime_ns:
+        return (None)
+    return (idx)
+
+
+def read_window(path, start=None, end=None, columns=None, sort_key="time"):
+    """ Read an inclusive range of an indexed csv table, parsing only that part of the file
+
+    Parameters
+    ----------
+    path : str
+        csv table with a current sidecar index, see index_table; one is built when missing
+    start, end : str, timestamp or number
+        inclusive range of the sort key, open ended when None
+    columns : list
+        columns to parse, all by default; the sort key is always kept
+
+    Returns
+    -------
+    dataframe
+    """
+    idx = load_index(path, sort_key) or index_table(path, sort_key)
+    if columns is not None and sort_key not in columns:
+        columns = [sort_key] + list(columns)
+
+    def key(x):
+        return (pd.to_datetime(x) if sort_key in ("time", "time_adj") else pd.to_numeric(x))
+
+    keys = key(pd.Series(idx["keys"], dtype=object)).to_numpy()
+    lo, hi = idx["header"], idx["size"]
+    if start is not None and len(keys):
+        # rows before the start can share the checkpoint block the start falls in
+        k = np.searchsorted(keys, key(pd.Series([start])).to_numpy()[0], side="left")
+        lo = idx["offsets"][max(k - 1, 0)]
+    if end is not None and len(keys):
+        k = np.searchsorted(keys, key(pd.Series([end])).to_numpy()[0], side="right")
+        hi = idx["offsets"][k] if k < len(keys) else idx["size"]
+
+    with open(path, "rb") as f:
+        f.seek(lo)
+        data = f.read(hi - lo)
+    df = pd.read_csv(io.BytesIO(data), header=None, names=idx["columns"], usecols=columns)
+
+    k = key(df[sort_key])
+    keep = np.ones(len(df), dtype=bool)
+    if start is not None:
+        keep &= (k >= key(pd.Series([start]))[0]).to_numpy()
+    if end is not None:
+        keep &= (k <= key(pd.Series([end]))[0]).to_numpy()
+    return (df[keep].reset_index(drop=True))
+
+
+def _arrow_table(df, category):
+    """Arrow table with the explicit schema of the category"""
+    pa = _pyarrow()
+    df = apply_schema(df.copy(), category)
+    fields = [pa.field(str(x), pa.from_numpy_dtype(dt)) for x, dt in df.dtypes.items()]
+    return (pa.Table.from_pandas(df, schema=pa.schema(fields), preserve_index=False))
+
+
+class TableWriter():
+    """Write tables on background threads so the next pipeline stage can start right away
+
+    Frames handed to submit must not be modified afterwards. close waits for every write and
+    raises the first error; use the writer as a context manager to close it automatically.
+    With a tables.instrument.RunReport every write is recorded as a "write" stage.
+    """
+
+    def __init__(self, workers=1, report=None):
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = []
+        self._report = report
+
+    def _write(self, df, path, category):
+        if self._report is None:
+            return (write_table(df, path, category))
+        with self._report.stage("write", file=str(path), rows=len(df)) as rec:
+            write_table(df, path, category)
+            rec["bytes_written"] = os.path.getsize(path)
+
+    def submit(self, df, path, category=None):
+        job = self._pool.submit(self._write, df, path, category)
+        self._pending.append(job)
+        return (job)
+
+    def close(self):
+        try:
+            for x in self._pending:
+                x.result()
+        finally:
+            self._pending = []
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return (self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _category(path):
+    """Table suffix from a file name like OWS19_amp_beam1.csv or OWS19000_table_bins.csv"""
+    stem = os.path.splitext(os.path.basename(str(path)))[0]
+    return (stem.split("_", 1)[-1])
@@ -0,0 +1,175 @@
+""" Follow a growing raw adcp file and append its new ensembles to the stacked tables
+
+For moored deployments with telemetry: every poll decodes only the bytes appended since the last one,
+builds the subset, converted time series and mb rows of those ensembles and appends them to the
+stacked csv's of the lake-year. Work per poll is bounded by `batch` bytes so memory stays constant,
+and the byte offset reached is saved next to the tables so a restarted follower carries on. The size
+of every table is checkpointed before a step appends to it, and a follower restarted after a step
+that died part way truncates the tables back to those sizes before going on, so no row is doubled.
+"""
+
+import os
+import glob
+import json
+import time
+import numpy as np
+
+from temp_module.geometry import bin_geometry
+from tables.reader import ChecksumError, NoEnsembleError, read_pd0
+from tables.subsetter import export_tables
+from tables.converter import tec, mb_build_beams
+
+BEAMS = ["beam1", "beam2", "beam3", "beam4", "avg"]
+
+
+class Follower():
+    """Tail one raw file into the stacked tables of its lake-year
+
+    Instance attributes
+    -------------------
+    raw_file: growing PD0 file
+    prefix: stacked table prefix, ex: .../adcp_tables_stacked/OWS19/OWS19_
+    offset: byte offset of the first ensemble not yet appended
+    rows: ensembles appended by this follower
+    """
+
+    def __init__(self, raw_file, eyedee, stacked_dir, batch=1 << 24, compact=False, append=False):
+        """
+        raw_file: ex: "/home/mpoe/adcp_habs/data/RawDataClean/2019/OWS19000r.000"
+        eyedee: lake-year id, ex: OWS19
+        stacked_dir: ex: "/home/mpoe/adcp_habs/data/adcp_tables_stacked/"
+        batch: most bytes decoded per step, larger than an ensemble
+        compact: build the rows with the compact dtypes, see tables.subsetter.export_tables
+        append: follow a raw file from its start onto stacked tables that already hold rows, ex: the
+            next file of a deployment; refused otherwise, those rows would likely be appended twice
+        """
+        self.raw_file = raw_file
+        self.prefix = stacked_dir + eyedee + "/" + eyedee + "_"
+        self.batch = batch
+        self.compact = compact
+        self.rows = 0
+        os.makedirs(stacked_dir + eyedee, exist_ok=True)
+        self._state = self.prefix + "stream.json"
+        self.offset = 0
+        state = None
+        if os.path.exists(self._state):
+            with open(self._state) as f:
+                state = json.load(f)
+            if state.get("pending"):
+                # a step that died part way: drop what it appended, its ensembles are read again
+                _rollback(state["pending"])
+                _write_state(self._state, dict(state, pending=None))
+        if state is not None and state["raw_file"] == raw_file:
+            self.offset = state["offset"]
+        elif not append and glob.glob(self.prefix + "*time_series.csv"):
+            raise ValueError(self.prefix + "* tables already hold rows, not following " + raw_file +
+                             " from its start; pass append=True if it is a new file of the deployment")
+
+    def step(self):
+        """ Append the complete ensembles written since the last step, at most batch bytes of them
+
+        Returns
+        -------
+        int
+            ensembles appended, 0 when nothing new is complete yet
+
+        Bytes that hold no ensemble are skipped. A change of bin or beam count within the file raises
+        a ValueError, its ensembles do not fit the stacked tables.
+        """
+        if os.path.getsize(self.raw_file) <= self.offset:
+            return (0)
+        try:
+            cc = read_pd0(self.raw_file, self.offset, self.batch)
+        except ChecksumError as error:
+            # complete but corrupt ensembles, nothing to append from them
+            print("skipping corrupt ensembles of", self.raw_file, "up to byte", error.end)
+            self.offset = error.end
+            self._save(None)
+            return (0)
+        except NoEnsembleError as error:
+            # garbage is skipped up to the next header, an ensemble only partly written so far waits
+            if error.end > self.offset:
+                print("skipping bytes of", self.raw_file, "without ensembles up to byte", error.end)
+                self.offset = error.end
+                self._save(None)
+            return (0)
+
+        tables = export_tables(cc, compact=self.compact)
+        ts = tables["table_time_series"]
+        tables["converted_time_series"] = tec(ts)
+        amps = {i: tables["amp_" + i] for i in BEAMS}
+        mb_dtype = np.float32 if self.compact else np.float64
+        for i, df in mb_build_beams(amps, ts, geometry=bin_geometry(cc["distance"]), dtype=mb_dtype).items():
+            tables["mb_" + i] = df
+
+        # checkpoint the size of every table this step touches, None for the ones it creates
+        bins = tables.pop("table_bins")
+        paths = [self.prefix + x + ".csv" for x in ["table_bins"] + list(tables)]
+        self._save({x: os.path.getsize(x) if os.path.exists(x) else None for x in paths})
+
+        # bins are fixed for a deployment, written once
+        if not os.path.exists(self.prefix + "table_bins.csv"):
+            bins.to_csv(self.prefix + "table_bins.csv", index=False)
+        for suffix, df in tables.items():
+            path = self.prefix + suffix + ".csv"
+            df.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+        # the offset only moves once every table has its rows
+        self.offset = cc["end"]
+        self.rows += len(ts)
+        self._save(None)
+        return (len(ts))
+
+    def _save(self, pending):
+        """pending: table sizes before a step, None once it is done"""
+        _write_state(self._state, {"raw_file": self.raw_file, "offset": self.offset, "pending": pending})
+
+    def follow(self, poll=2.0, idle=None):
+        """ Keep appending as the file grows
+
+        poll: seconds between checks when nothing new arrived
+        idle: stop after this many seconds without new ensembles, never by default
+        Returns the number of ensembles appended
+        """
+        quiet = time.monotonic()
+        while True:
+            n = self.step()
+            if n:
+                print(time.strftime("%H:%M:%S"), "appended", n, "ensembles from", self.raw_file)
+                quiet = time.monotonic()
+                continue
+            if idle is not None and time.monotonic() - quiet > idle:
+                return (self.rows)
+            time.sleep(poll)
+
+
+def _write_state(path, state):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def _rollback(pending):
+    """truncate tables back to their checkpointed sizes, removing the ones created since"""
+    for path, size in (pending or {}).items():
+        if size is None:
+            if os.path.exists(path):
+                os.remove(path)
+        elif os.path.exists(path):
+            os.truncate(path, size)
+
+
+def stream_mb(raw_file, eyedee, stacked_dir, poll=2.0, idle=None, compact=False, append=False):
+    """Follow a growing raw file into the stacked csv tables, see Follower"""
+    return (Follower(raw_file, eyedee, stacked_dir, compact=compact, append=append).follow(poll, idle))
+
+
+if __name__ == '__main__':
+    # ex: raw_file = "/home/mpoe/adcp_habs/data/RawDataClean/2019/OWS19000r.000"
+    raw_file = input("growing raw data file path: ")
+    # ex: eyedee = 'OWS19'
+    eyedee = input("lake id: ")
+    # ex: stacked_dir = "/home/mpoe/adcp_habs/data/adcp_tables_stacked/"
+    stacked_dir = input("stacked table directory path: ")
+    stream_mb(raw_file, eyedee, stacked_dir)
@@ -0,0 +1,51 @@
+import numpy as np
+from functools import lru_cache
+from . import constants
+"""Precomputed depth-only sonar terms for a set of bins.
+
+The beam angle, slant range, pressure and transmit length correction of the sonar equation only
+depend on bin depth and the constants of temp_module.constants, so they are computed once per bin
+and shared by every ensemble, beam and table instead of being rebuilt with each TempMb.
+
+Functions
+---------
+bin_geometry: Return the cached BinGeometry for an array of bin depths
+"""
+
+
+class BinGeometry():
+    """Depth-only terms of Sonar and TempMb evaluated for every bin
+
+    Instance attributes
+    -------------------
+    cell_depth: bin depths in m
+    cosine_theta: cosine of the beam angle
+    r_slant: slant distance to the middle of each bin
+    pressure: pressure term of the water absorption
+    correction: transmit length correction in dB
+    """
+
+    def __init__(self, cell_depth, theta, l_xmit, rho_w, g, p_scale):
+        self.cell_depth = np.asarray(cell_depth, dtype=float)
+        self.cosine_theta = np.cos(np.deg2rad(theta))
+        self.r_slant = (self.cell_depth + (0.5 * l_xmit)) / self.cosine_theta
+        self.pressure = 1 - (p_scale * (rho_w * g * self.cell_depth) * 0.00000987)
+        self.correction = 10 * np.log10(l_xmit/self.cosine_theta)
+        # cached instances are shared, keep them from being modified in place
+        for x in (self.cell_depth, self.r_slant, self.pressure):
+            x.setflags(write=False)
+
+
+def bin_geometry(cell_depth):
+    """ Return the BinGeometry for the given bin depths, ex: table_bins["bin_depth"]
+        Cached on the depths and on the current THETA, L_XMIT, RHO_W, G and P_SCALE,
+        so changing any of them in temp_module.constants gives freshly computed terms
+    """
+    depths = tuple(float(x) for x in np.ravel(cell_depth))
+    return (_bin_geometry(depths, constants.THETA, constants.L_XMIT, constants.RHO_W,
+                          constants.G, constants.P_SCALE))
+
+
+@lru_cache(maxsize=64)
+def _bin_geometry(depths, theta, l_xmit, rho_w, g, p_scale):
+    return (BinGeometry(depths, theta, l_xmit, rho_w, g, p_scale))
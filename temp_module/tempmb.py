@@ -1,5 +1,6 @@
 import numpy as np
 from .constants import *
+from .geometry import bin_geometry
 """Return properties and parameters for sonar and backscatter theory.
 
 Classes
@@ -10,16 +11,22 @@ TempMb: Calculate measured backscatter and
 """
 
 class Sonar():
-    """Define fundamental physics of sonar theory for use with backscatter"""
+    """Define fundamental physics of sonar theory for use with backscatter
+    geometry: optional geometry.BinGeometry of the cell depths; its precomputed depth-only terms are
+    looked up instead of recomputed
+    """
 
-    def __init__(self, cell_depth, temperature):
+    def __init__(self, cell_depth, temperature, geometry=None):
         self.cell_depth = cell_depth 
         self.temperature = temperature
+        self.geometry = geometry
 
     @property
     def cosine_theta(self):
         """Cosine of the beam angle from the transducer
         """
+        if self.geometry is not None:
+            return(self.geometry.cosine_theta)
         angle = np.deg2rad(THETA)
         return(np.cos(angle))
 
@@ -28,6 +35,8 @@ class Sonar():
             # calculated in pascals, then converted to atmospheres 
             # see documentation: https://pubs.usgs.gov/tm/03/c05/tm3c5.pdf
         """
+        if self.geometry is not None:
+            return(self.geometry.pressure)
         h = self.cell_depth
         P = RHO_W * G * h
         return (1 - (P_SCALE * P * 0.00000987)) 
@@ -44,6 +53,8 @@ class Sonar():
     def r_slant(self): 
         """R(r(D, theta), Lxmit) dependent on slant distance from transducer to middle of bin
         """
+        if self.geometry is not None:
+            return(self.geometry.r_slant)
         return ((self.cell_depth + (0.5 * L_XMIT)) / self.cosine_theta)  # WRII documentation
     
         # return (self.cell_depth/self.cosine_theta) # slant distance
@@ -94,8 +105,8 @@ class Sonar():
     
 class TempMb(Sonar):
     """Inherit Sonar class to calculate measured backscatter and eventually temperature"""
-    def __init__(self, cell_depth, amp, t_c, t_att, t_amb,):
-        super().__init__(cell_depth, t_c)
+    def __init__(self, cell_depth, amp, t_c, t_att, t_amb, geometry=None):
+        super().__init__(cell_depth, t_c, geometry)
         self.amp = amp
         self.cell_depth = cell_depth 
         self.t_c = t_c
@@ -129,6 +140,8 @@ class TempMb(Sonar):
     #     return(2 * self.alpha_s() * self.r_slant())
     
     def correction(self):
+        if self.geometry is not None:
+            return(self.geometry.correction)
         return(10 * np.log10(L_XMIT/self.cosine_theta))
 
     def measured_backscatter(self):
@@ -172,6 +185,91 @@ class TempMb(Sonar):
         return (off_set + ((a3*x + a2)*x + a1)*x + a0)
 
 
+def mb_matrix(amp, cell_depth, t_c, t_att, t_amb, geometry=None):
+    """ Measured backscatter for a whole amplitude table in one broadcast evaluation
+        amp: (time, bin) amplitude counts
+        cell_depth: (bin,) bin depths
+        t_c, t_att, t_amb: (time,) per ensemble temperatures
+        geometry: BinGeometry of cell_depth, looked up from the cache when not given
+        Returns the (time, bin) values TempMb(depth, amp, ...).measured_backscatter() gives column by column
+    """
+    amp = np.asarray(amp, dtype=float)
+    t_c, t_att, t_amb = (np.asarray(x, dtype=float)[:, None] for x in (t_c, t_att, t_amb))
+    if amp.shape[0] != t_c.shape[0]:
+        raise ValueError("amplitude table and time series have different lengths")
+    cell_depth = np.asarray(cell_depth, dtype=float)
+    if geometry is None:
+        geometry = bin_geometry(cell_depth)
+    elif not np.array_equal(geometry.cell_depth, cell_depth):
+        raise ValueError("bin geometry was built for different bin depths")
+    return (TempMb(cell_depth, amp, t_c, t_att, t_amb, geometry).measured_backscatter())
+
+
+def ensemble_terms(t_c, t_att, t_amb, dtype=np.float64):
+    """ Per ensemble factors of the sonar equation, shared by every bin and beam
+        Returns amplitude scale, inverse rayleigh distance and water absorption factor, each (time,)
+    """
+    tmb = TempMb(0, 0, np.asarray(t_c, dtype=float), np.asarray(t_att, dtype=float), np.asarray(t_amb, dtype=float))
+    scale = tmb.c_amp_scale()
+    inv_rn = 1/tmb.rayleigh_distance()
+    alfa = NEPER * B_W * F**2 * 1/(tmb.f_t())
+    return (tuple(np.asarray(x, dtype=dtype) for x in (scale, inv_rn, alfa)))
+
+
+def mb_fused(amp, geometry, t_c, t_att, t_amb, out=None, dtype=np.float64, terms=None, block=None):
+    """ Measured backscatter evaluated in place, block by block, into a preallocated output
+        Same sonar equation as TempMb.measured_backscatter, split into per ensemble terms (time,),
+        per bin terms (bin,) from the BinGeometry, and two scratch blocks reused for every chunk
+        amp: (time, bin) amplitude counts, any numeric dtype
+        out: (time, bin) output array, allocated with dtype when not given
+        dtype: np.float64 or np.float32, precision of the evaluation
+        terms: ensemble_terms of the time series when already computed
+        block: rows per chunk, by default sized so a scratch block stays around 256 kB
+    """
+    n, ln = amp.shape
+    if out is None:
+        out = np.empty((n, ln), dtype=dtype)
+    if terms is None:
+        terms = ensemble_terms(t_c, t_att, t_amb, dtype)
+    scale, inv_rn, alfa = terms
+    if len(scale) != n:
+        raise ValueError("amplitude table and time series have different lengths")
+
+    # per bin terms: 20 log10(r) of the beam spreading, 2 r (1 - P_SCALE p) of the water absorption
+    r = np.asarray(geometry.r_slant, dtype=dtype)
+    log_r = (20 * np.log10(geometry.r_slant)).astype(dtype)
+    absorb = (2 * (1 - P_SCALE * geometry.pressure) * geometry.r_slant).astype(dtype)
+    correction = np.dtype(dtype).type(geometry.correction)
+
+    if block is None:
+        block = max(1, (1 << 18) // (ln * np.dtype(dtype).itemsize))
+    x_buf = np.empty((block, ln), dtype=dtype)
+    y_buf = np.empty((block, ln), dtype=dtype)
+
+    for i in range(0, n, block):
+        j = min(i + block, n)
+        o, x, y = out[i:j], x_buf[:j-i], y_buf[:j-i]
+        # near field psi = 1 + 1/(1.35 r/r_n + (2.5 r/r_n)**3.2)
+        np.multiply(inv_rn[i:j, None], r, out=x)
+        np.multiply(x, 2.5, out=y)
+        np.power(y, 3.2, out=y)
+        np.multiply(x, 1.35, out=x)
+        np.add(x, y, out=x)
+        np.reciprocal(x, out=x)
+        np.add(x, 1, out=x)
+        # 20 log10(r psi) = 20 log10(psi) + 20 log10(r)
+        np.log10(x, out=x)
+        np.multiply(x, 20, out=x)
+        np.add(x, log_r, out=x)
+        # source level + beam spreading + water absorption - correction
+        np.multiply(amp[i:j], scale[i:j, None], out=o, casting="unsafe")
+        np.add(o, x, out=o)
+        np.multiply(alfa[i:j, None], absorb, out=y)
+        np.add(o, y, out=o)
+        np.subtract(o, correction, out=o)
+    return (out)
+
+
 class Xmit():
     """Provide converted values for transmitted power, voltage, and current
     Reference power is 1 Watt
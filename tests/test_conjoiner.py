@@ -0,0 +1,56 @@
+""" Stacking of overlapping deployment files by tables.conjoiner.aggr_df """
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tables.conjoiner import aggr_df, merge_sorted
+
+
+def _separated(dir1, name, start, n):
+    """one separated amp_avg table of n ensembles, 10 minutes apart"""
+    time = pd.date_range(start, periods=n, freq="10min")
+    df = pd.DataFrame({"time": time, "8.61": np.arange(n, dtype=float), "9.61": np.arange(n, dtype=float) * 2})
+    (dir1 / name).mkdir()
+    df.to_csv(dir1 / name / (name + "_amp_avg.csv"), index=False)
+    return (df)
+
+
+@pytest.fixture
+def overlapping(tmp_path):
+    """two files of a lake-year sharing their last and first 12 ensembles"""
+    dir1 = tmp_path / "tables"
+    dir1.mkdir()
+    a = _separated(dir1, "OWS19000", "2019-06-01 00:00", 48)
+    b = _separated(dir1, "OWS19001", "2019-06-01 06:00", 48)
+    b.iloc[:12, 1:] = a.iloc[36:, 1:].to_numpy()
+    b.to_csv(dir1 / "OWS19001" / "OWS19001_amp_avg.csv", index=False)
+    return (str(dir1) + "/", str(tmp_path / "stacked") + "/")
+
+
+def test_budget_drops_overlap(overlapping):
+    dir1, dir2 = overlapping
+    rows = aggr_df("OWS19", "amp_avg", dir1, dir2, budget=10)
+    stacked = pd.read_csv(dir2 + "OWS19/OWS19_amp_avg.csv", parse_dates=["time"])
+    assert rows == len(stacked) == 84
+    assert stacked["time"].is_unique and stacked["time"].is_monotonic_increasing
+
+
+def test_budget_matches_in_memory(overlapping):
+    dir1, dir2 = overlapping
+    in_memory = aggr_df("OWS19", "amp_avg", dir1, None, dedupe=True)
+    in_memory["time"] = pd.to_datetime(in_memory["time"])
+    aggr_df("OWS19", "amp_avg", dir1, dir2, budget=10)
+    stacked = pd.read_csv(dir2 + "OWS19/OWS19_amp_avg.csv", parse_dates=["time"])
+    pd.testing.assert_frame_equal(stacked, in_memory, check_dtype=False)
+
+
+def test_in_memory_keeps_overlap_by_default(overlapping):
+    dir1, _ = overlapping
+    assert len(aggr_df("OWS19", "amp_avg", dir1, None)) == 96
+
+
+def test_merge_without_inputs_writes_nothing(tmp_path):
+    pt_file = str(tmp_path / "OWS19_amp_avg.csv")
+    assert merge_sorted([], pt_file, "amp_avg") == 0
+    assert not (tmp_path / "OWS19_amp_avg.csv").exists()
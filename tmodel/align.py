@@ -0,0 +1,110 @@
+"""Pair adcp backscatter with flx sensor temperatures by nearest time and depth
+
+Every flx reading is matched to the adcp bin facing its sensor and to the adcp ensemble closest
+in time, for all sensor depths at once: bin depths and ensemble times are sorted keys and the
+matches are found with np.searchsorted, so a season of readings aligns in milliseconds.
+"""
+
+import numpy as np
+import pandas as pd
+
+# sensor depth + 0.61 is the adcp bin facing the sensor, the convention of select and sel_bub
+BIN_OFFSET = 0.61
+
+
+def nearest(keys, values):
+    """ Index of the nearest sorted key for every value and its distance
+
+    Parameters
+    ----------
+    keys : array
+        sorted ascending
+    values : array
+        any order
+
+    Returns
+    -------
+    tuple
+        (indices into keys, absolute distances); -1 and NaN for every value when keys is empty
+    """
+    keys, values = np.asarray(keys), np.asarray(values)
+    if len(keys) == 0:
+        return (np.full(len(values), -1), np.full(len(values), np.nan))
+    right = np.clip(np.searchsorted(keys, values), 1, len(keys) - 1) if len(keys) > 1 else np.zeros(len(values), int)
+    left = np.maximum(right - 1, 0)
+    d_left, d_right = np.abs(values - keys[left]), np.abs(keys[right] - values)
+    pick = np.where(d_right < d_left, right, left)
+    return (pick, np.minimum(d_left, d_right))
+
+
+def align(adcp, flx, start=None, end=None, depths=None, time_tol="10min", depth_tol=0.5, offset=BIN_OFFSET,
+          dropna=True):
+    """ Align a wide adcp table with flx readings
+
+    Parameters
+    ----------
+    adcp : dataframe
+        time column and one column per bin depth, ex: a stacked mb_avg table
+    flx : dataframe
+        Timestamp_EST (or time), Temperature_C and Depth_m columns, ex: flx_most_recent.csv of one site
+    start, end : str or timestamp
+        exclusive time window of the flx readings, all of them by default
+    depths : list
+        sensor depths to keep, all by default
+    time_tol : str or timedelta
+        largest time difference between a reading and its ensemble
+    depth_tol : float
+        largest difference between sensor depth + offset and the bin depth, in m
+    offset : float
+        added to the sensor depth before looking up its bin
+    dropna : boolean
+        drop pairs whose backscatter is missing
+
+    Returns
+    -------
+    dataframe
+        one row per matched reading, sorted by depth and time: time, Depth_m, Temperature_C,
+        bin_depth, adcp_time and mb
+    """
+    # ---- flx readings in the window
+    t_flx = pd.to_datetime(flx["time"] if "time" in flx else flx["Timestamp_EST"]).to_numpy()
+    temp = flx["Temperature_C"].to_numpy(dtype=float)
+    sensor = flx["Depth_m"].to_numpy(dtype=float)
+    keep = np.ones(len(flx), dtype=bool)
+    if start is not None:
+        keep &= t_flx > np.datetime64(pd.Timestamp(start))
+    if end is not None:
+        keep &= t_flx < np.datetime64(pd.Timestamp(end))
+    if depths is not None:
+        keep &= np.isin(sensor, np.asarray(depths, dtype=float))
+    t_flx, temp, sensor = t_flx[keep], temp[keep], sensor[keep]
+
+    # ---- sorted adcp keys: ensemble times and bin depths
+    t_adp = pd.to_datetime(adcp["time"]).to_numpy()
+    cols = [x for x in adcp.columns if not str(x).startswith("time")]
+    bins = np.array([float(x) for x in cols])
+    # stacked tables are already in time order, no sorted copy needed then
+    if np.all(t_adp[1:] >= t_adp[:-1]):
+        by_time, t_sorted = np.arange(len(t_adp)), t_adp
+    else:
+        by_time = np.argsort(t_adp, kind="stable")
+        t_sorted = t_adp[by_time]
+    by_depth = np.argsort(bins, kind="stable")
+    b_sorted = bins[by_depth]
+
+    # ---- nearest ensemble and bin for every reading at once
+    ti, dt = nearest(t_sorted.view(np.int64), t_flx.view(np.int64))
+    bi, dd = nearest(b_sorted, sensor + offset)
+    ok = (dt <= pd.Timedelta(time_tol).value) & (dd <= depth_tol)
+    rows, cells = by_time[ti[ok]], by_depth[bi[ok]]
+
+    # gathered a column at a time so memory follows the number of readings, not the adcp grid
+    mb = np.full(len(rows), np.nan)
+    for k in np.unique(cells):
+        hit = cells == k
+        mb[hit] = adcp[cols[k]].to_numpy()[rows[hit]]
+    out = pd.DataFrame({"time": t_flx[ok], "Depth_m": sensor[ok], "Temperature_C": temp[ok],
+                        "bin_depth": bins[cells], "adcp_time": t_adp[rows], "mb": mb})
+    if dropna:
+        out = out[np.isfinite(out["mb"].to_numpy())]
+    return (out.sort_values(["Depth_m", "time"], kind="stable", ignore_index=True))
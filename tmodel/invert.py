@@ -0,0 +1,189 @@
+"""Convert backscatter tables to temperature through precomputed lookup grids
+
+The empirical model of tmodel.tempfit maps temperature to backscatter. It is evaluated once per bin on
+a fine temperature grid, trimmed to its longest monotone branch, and whole mb tables (time x bin) are
+then turned into temperature by interpolating in those grids, without root finding. Where the model
+is not monotone over the grid, backscatter values the discarded part also reaches have two
+temperatures and come back as NaN.
+"""
+
+import numpy as np
+import pandas as pd
+
+from tables.storage import index_table, write_table
+from tmodel.align import BIN_OFFSET
+from tmodel.tempfit import temp_model
+
+
+class TempLookup():
+    """Backscatter to temperature grids of a set of bins
+
+    Instance attributes
+    -------------------
+    bin_depth: bin depths in m
+    temperature: (bins, grid) temperatures, increasing with the backscatter of the same row
+    backscatter: (bins, grid) model backscatter, strictly increasing along each row; all NaN for a
+        bin without parameters
+    ambiguous: (bins, 2, 2) backscatter ranges reached by the grid on either side of the kept branch,
+        NaN where the branch covers that end of the grid; values inside them are not inverted
+    monotone: (bins,) the kept branch spans the whole grid
+    """
+
+    def __init__(self, bin_depth, params, t_range=(0, 30), step=0.01):
+        """ Evaluate the model on the temperature grid of every bin
+
+        Parameters
+        ----------
+        bin_depth : array
+            depths of the bins, the mb table columns
+        params : array
+            (bins, 2) model parameters a and b of each bin, NaN for bins left unconverted
+        t_range : tuple
+            temperatures covered, in C
+        step : float
+            grid spacing in C
+        """
+        self.bin_depth = np.asarray(bin_depth, dtype=float)
+        params = np.asarray(params, dtype=float).reshape(len(self.bin_depth), 2)
+        grid = np.arange(t_range[0], t_range[1] + step/2, step)
+
+        y = temp_model(grid[None, :], params[:, :1], params[:, 1:])
+        self.temperature = np.full(y.shape, np.nan)
+        self.backscatter = np.full(y.shape, np.nan)
+        self.ambiguous = np.full((len(y), 2, 2), np.nan)
+        self.monotone = np.zeros(len(y), dtype=bool)
+        for k in range(len(y)):
+            lo, hi = _monotone_run(y[k])
+            self.monotone[k] = lo == 0 and hi == y.shape[1]
+            for j, rest in enumerate((y[k, :lo], y[k, hi:])):
+                rest = rest[np.isfinite(rest)]
+                if len(rest):
+                    self.ambiguous[k, j] = rest.min(), rest.max()
+            t, b = grid[lo:hi], y[k, lo:hi]
+            if len(b) > 1 and b[-1] < b[0]:
+                t, b = t[::-1], b[::-1]
+            self.temperature[k, :len(t)] = t
+            self.backscatter[k, :len(b)] = b
+
+    def to_temperature(self, mb):
+        """ Temperature for every value of a backscatter array or mb table
+
+        Parameters
+        ----------
+        mb : dataframe or array
+            mb_* table with a time column and one column per bin, or a (time, bin) array in the
+            order of bin_depth
+
+        Returns
+        -------
+        dataframe or array
+            same shape; NaN outside the range of a bin's grid and where the model gives the value at
+            two temperatures of the grid
+        """
+        if isinstance(mb, pd.DataFrame):
+            cols = [x for x in mb.columns if not str(x).startswith("time")]
+            out = self.to_temperature(mb[cols].to_numpy(dtype=float))
+            df = pd.DataFrame(out, columns=cols, index=mb.index)
+            df.insert(0, "time", mb["time"])
+            return (df)
+
+        mb = np.asarray(mb, dtype=float)
+        out = np.full(mb.shape, np.nan)
+        for k in range(mb.shape[1]):
+            b = self.backscatter[k]
+            n = np.count_nonzero(np.isfinite(b))
+            if n > 1:
+                out[:, k] = np.interp(mb[:, k], b[:n], self.temperature[k, :n], left=np.nan, right=np.nan)
+            for lo, hi in self.ambiguous[k]:
+                if np.isfinite(lo):
+                    out[(mb[:, k] >= lo) & (mb[:, k] <= hi), k] = np.nan
+        return (out)
+
+
+def _monotone_run(y):
+    """start and stop of the longest strictly monotone run of finite values"""
+    ok = np.isfinite(y)
+    d = np.sign(np.diff(y))
+    # a step belongs to a run when both ends are finite and it keeps the direction of the previous step
+    breaks = np.flatnonzero((d[1:] != d[:-1]) | ~ok[1:-1] | (d[1:] == 0)) + 1
+    edges = np.concatenate([[0], breaks, [len(y) - 1]])
+    best, span = (0, 0), -1
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        if ok[lo] and ok[hi] and d[lo] != 0 and hi - lo > span:
+            best, span = (lo, hi + 1), hi - lo
+    return (best)
+
+
+def lookup(fits, bin_depth, offset=BIN_OFFSET, t_range=(0, 30), step=0.01, lake=None, window=None):
+    """ Build the TempLookup of a set of bins from fitted parameters
+
+    Parameters
+    ----------
+    fits : dataframe or tuple
+        rows of tempfit.fit_grid (depth, a, b); bins facing a sensor depth (depth + offset) get
+        its parameters, other bins stay NaN. The rows must come from one lake and one window, pick
+        them with lake and window when fits holds several. A single (a, b) applies to every bin
+    bin_depth : array
+        depths of the bins, ex: table_bins["bin_depth"]
+    offset : float
+        sensor depth + offset = depth of the bin facing the sensor
+    t_range, step :
+        temperature grid, see TempLookup
+    lake : str
+        rows of this lake of a multi lake fit_grid
+    window : tuple
+        (start, end) of the fit_grid window to use
+
+    Returns
+    -------
+    TempLookup
+    """
+    bin_depth = np.asarray(bin_depth, dtype=float)
+    if not isinstance(fits, pd.DataFrame):
+        return (TempLookup(bin_depth, np.tile(np.asarray(fits, dtype=float), (len(bin_depth), 1)), t_range, step))
+
+    if lake is not None:
+        fits = fits[fits["lake"] == lake]
+    if window is not None:
+        fits = fits[(fits["start"] == pd.Timestamp(window[0])) & (fits["end"] == pd.Timestamp(window[1]))]
+    if "lake" in fits and fits["lake"].nunique(dropna=False) > 1:
+        raise ValueError("fits hold several lakes, pick one with lake=")
+    if "start" in fits and len(fits[["start", "end"]].drop_duplicates()) > 1:
+        raise ValueError("fits hold several windows, pick one with window=(start, end)")
+
+    params = np.full((len(bin_depth), 2), np.nan)
+    fits = fits.dropna(subset=["a", "b"])
+    for depth, a, b in zip(fits["depth"], fits["a"], fits["b"]):
+        k = np.flatnonzero(np.isclose(bin_depth, depth + offset))
+        params[k] = (a, b)
+    return (TempLookup(bin_depth, params, t_range, step))
+
+
+def temp_build(mb_table, fits, bin_depth=None, pt_dir=None, offset=BIN_OFFSET, lake=None, window=None):
+    """ Temperature table of a whole mb table, the inversion stage after mb_build
+
+    Parameters
+    ----------
+    mb_table : dataframe
+        mb_* table, time and one column per bin depth
+    fits : dataframe or tuple
+        fitted model parameters, see lookup
+    lake, window :
+        rows of fits to use, see lookup
+    bin_depth : array
+        bin depths, from the mb table columns by default
+    pt_dir : str
+        optional output path, ex: .../OWS19/OWS19_temp_avg.csv
+
+    Returns
+    -------
+    dataframe
+        temperature in C with the layout of mb_table
+    """
+    if bin_depth is None:
+        bin_depth = [float(x) for x in mb_table.columns if not str(x).startswith("time")]
+    df = lookup(fits, bin_depth, offset, lake=lake, window=window).to_temperature(mb_table)
+    if pt_dir is not None:
+        write_table(df, pt_dir)
+        index_table(pt_dir)
+    return (df)
@@ -0,0 +1,120 @@
+"""Level of detail aggregation for plotting long records
+
+Points are binned into a screen resolution grid holding the count, sum, min and max of a value per
+cell, so a figure costs one image instead of millions of markers. Grids are filled chunk by chunk
+with add(), ex: one month of a stacked table at a time, and drawn with plot().
+"""
+
+import numpy as np
+import pandas as pd
+
+# selections with more points than this are drawn through a DensityGrid by model_fit and bubble
+LOD_POINTS = 50000
+
+
+def _numeric(x):
+    """float values of an axis; times become ns since the epoch"""
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return (x.astype("datetime64[ns]").astype(np.int64).astype(float))
+    if x.dtype == object:
+        return (pd.to_datetime(x).to_numpy().astype("datetime64[ns]").astype(np.int64).astype(float))
+    return (x.astype(float))
+
+
+class DensityGrid():
+    """Count, sum, min and max of a value over a fixed 2-D grid
+
+    Instance attributes
+    -------------------
+    x_edges, y_edges: cell edges, times as ns since the epoch
+    time_x: x is a time axis
+    count, total, low, high: (ny, nx) per cell statistics of the value; low and high are NaN in
+        empty cells
+    """
+
+    def __init__(self, x_range, y_range, shape=(800, 600)):
+        """
+        x_range, y_range: (min, max) of the axes, timestamps for a time axis
+        shape: (nx, ny) cells, about the pixel size of the figure
+        """
+        self.time_x = not np.isscalar(x_range[0]) or isinstance(x_range[0], (str, pd.Timestamp, np.datetime64))
+        x_range = _numeric(pd.to_datetime(list(x_range)) if self.time_x else list(x_range))
+        self.x_edges = np.linspace(x_range[0], x_range[1], shape[0] + 1)
+        self.y_edges = np.linspace(float(y_range[0]), float(y_range[1]), shape[1] + 1)
+        nx, ny = shape
+        self.count = np.zeros((ny, nx), dtype=np.int64)
+        self.total = np.zeros((ny, nx))
+        self.low = np.full((ny, nx), np.nan)
+        self.high = np.full((ny, nx), np.nan)
+
+    def add(self, x, y, value=None):
+        """ Accumulate a chunk of points; points outside the grid or with missing values are skipped
+
+        Parameters
+        ----------
+        x, y : array
+            coordinates
+        value : array
+            value aggregated per cell, ex: mb; only counts are kept without it
+        """
+        x, y = _numeric(x), _numeric(y)
+        nx, ny = len(self.x_edges) - 1, len(self.y_edges) - 1
+        ix = np.floor((x - self.x_edges[0]) / (self.x_edges[-1] - self.x_edges[0]) * nx).astype(np.int64)
+        iy = np.floor((y - self.y_edges[0]) / (self.y_edges[-1] - self.y_edges[0]) * ny).astype(np.int64)
+        # the top edge belongs to the last cell
+        ix[x == self.x_edges[-1]] = nx - 1
+        iy[y == self.y_edges[-1]] = ny - 1
+        ok = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny) & np.isfinite(x) & np.isfinite(y)
+        if value is not None:
+            value = np.asarray(value, dtype=float)
+            ok &= np.isfinite(value)
+            value = value[ok]
+        flat = iy[ok] * nx + ix[ok]
+
+        self.count += np.bincount(flat, minlength=nx*ny).reshape(ny, nx)
+        if value is not None:
+            self.total += np.bincount(flat, weights=value, minlength=nx*ny).reshape(ny, nx)
+            low, high = self.low.reshape(-1), self.high.reshape(-1)
+            # fmin/fmax ignore the NaN of cells seen for the first time
+            np.fmin.at(low, flat, value)
+            np.fmax.at(high, flat, value)
+        return (self)
+
+    def mean(self):
+        """per cell mean of the value, NaN in empty cells"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (np.where(self.count > 0, self.total / self.count, np.nan))
+
+    def image(self, stat="count"):
+        """ count, mean, min or max per cell, NaN where nothing fell """
+        if stat == "count":
+            return (np.where(self.count > 0, self.count, np.nan))
+        return ({"mean": self.mean, "min": lambda: self.low, "max": lambda: self.high}[stat]())
+
+    def plot(self, ax=None, stat="count", **kwargs):
+        """ Draw one statistic as an image, ex: stat="mean" for the mean mb of each cell
+
+        Returns
+        -------
+        the matplotlib image, for colorbars
+        """
+        from matplotlib import pyplot as plt
+        from matplotlib import dates as mdates
+        ax = ax or plt.gca()
+        x_edges = self.x_edges
+        if self.time_x:
+            x_edges = mdates.date2num(pd.to_datetime(x_edges.astype(np.int64)))
+            ax.xaxis_date()
+        kwargs.setdefault("cmap", "viridis" if stat == "count" else "seismic")
+        return (ax.pcolormesh(x_edges, self.y_edges, self.image(stat), **kwargs))
+
+
+def grid_for(x, y, shape=(800, 600)):
+    """DensityGrid spanning the given points"""
+    x_num = _numeric(x)
+    time_x = np.issubdtype(np.asarray(x).dtype, np.datetime64) or np.asarray(x).dtype == object
+    lo, hi = np.nanmin(x_num), np.nanmax(x_num)
+    x_range = pd.to_datetime([int(lo), int(hi)]) if time_x else (lo, hi)
+    y_num = _numeric(y)
+    return (DensityGrid(x_range, (np.nanmin(y_num), np.nanmax(y_num)), shape))
@@ -1,70 +1,127 @@
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib import pyplot as plt
 from scipy.optimize import curve_fit 
 # from temp_module.tempmb import TempMb as tmb
 
-def select(adcp, flx, start, end, depth=0):
-    """function to choose data to work with by lake and time interal, choose a depth to create tables of a single depth"""
-    adcp['time'] = pd.to_datetime(adcp['time'])
-    select_adp = adcp[(adcp['time'] > start) & (adcp['time'] < end)]
+from tables.storage import read_table
+from tmodel.align import align
+from tmodel.lod import LOD_POINTS, DensityGrid, grid_for
 
-    flx['time'] = pd.to_datetime(flx['Timestamp_EST'])
-    flx = flx[['time', 'Temperature_C', 'Depth_m']]
-    select_flx = flx[(flx['time'] > start) & (flx['time'] < end)]
+def temp_model(x, a, b):
+    """backscatter as a function of temperature x, the general form fitted by model_fit and fit_grid"""
+    return ((x + a) * 10**(1520/(x + 273)))/b
 
-    if depth > 0:
-        select_adp = select_adp[['time', str(depth)+".61"]]
-        select_flx = select_flx[select_flx["Depth_m"] == depth]
-
-    def drop(tbl,n):
-        # Dropping last n rows using drop
-        tbl.drop(tbl.tail(n).index, inplace = True)
-        # randomly drop data to make dfs the same length 
-        np.random.seed(10)
-        drop_indices = np.random.choice(tbl.index, n, replace=False)
-        tbl_drop = tbl.drop(drop_indices)
-        return(tbl_drop.head())
-
-    # compare the two existing sets, and make the same size through random removal of excess rows
-    # TODO refactor the next block using either pd.resample(..., ) OR pd.merge_asof(..., method=nearest)
-
-    print(len(select_adp),"adp")
-    select_adp = select_adp.iloc[::3]
-    print(len(select_flx), "flx", len(select_adp), "adp")
 
-    if len(select_adp) > len(select_flx):
-        n = len(select_adp) - len(select_flx)
-        drop(select_adp, n)
-        print("Dropped "+str(n)+" random values from sel_adp")
+def linear_fit(temperature, backscatter):
+    """ Least squares fit of temp_model in closed form, for many series at once
+
+    temp_model is linear in u = 1/b and w = a/b: y = u*(x*E) + w*E with E = 10**(1520/(x + 273)),
+    so every fit is a 2x2 normal equation solved directly; the parameters and their covariance are
+    the ones curve_fit converges to, mapped back to a and b.
+
+    Parameters
+    ----------
+    temperature, backscatter : array
+        (..., points); series of different lengths are padded with NaN
+
+    Returns
+    -------
+    dict
+        arrays shaped like the leading axes: a, b, var_a, var_b, cov_ab, n, rmse, resid_mean, resid_max
+        and r2; NaN where a series has fewer than 3 points or is degenerate
+    """
+    x = np.asarray(temperature, dtype=float)
+    y = np.asarray(backscatter, dtype=float)
+    ok = np.isfinite(x) & np.isfinite(y)
+    x, y = np.where(ok, x, 0), np.where(ok, y, 0)
+    e = np.where(ok, 10**(1520/(x + 273)), 0)
+    xe = x * e
+    n = ok.sum(axis=-1)
+
+    # ---- normal equations, columns scaled to unit norm to keep them well conditioned
+    with np.errstate(divide="ignore", invalid="ignore"):
+        d1, d2 = np.sqrt(np.sum(xe*xe, axis=-1)), np.sqrt(np.sum(e*e, axis=-1))
+        m = np.sum(xe*e, axis=-1) / (d1*d2)
+        q1, q2 = np.sum(y*xe, axis=-1) / d1, np.sum(y*e, axis=-1) / d2
+        det = 1 - m*m
+        u = (q1 - m*q2) / det / d1
+        w = (q2 - m*q1) / det / d2
+
+        resid = np.where(ok, y - (u[..., None]*xe + w[..., None]*e), 0)
+        ssr = np.sum(resid**2, axis=-1)
+        s2 = ssr / (n - 2)
+        ybar = np.sum(y, axis=-1) / n
+        ss_tot = np.sum(np.where(ok, y - ybar[..., None], 0)**2, axis=-1)
+
+        # covariance of (u, w), then of (a, b) = (w/u, 1/u) through the jacobian
+        c_uu, c_ww, c_uw = s2/det/(d1*d1), s2/det/(d2*d2), -s2*m/det/(d1*d2)
+        ja_u, ja_w, jb_u = -w/u**2, 1/u, -1/u**2
+        out = {"a": w/u, "b": 1/u,
+               "var_a": ja_u*ja_u*c_uu + 2*ja_u*ja_w*c_uw + ja_w*ja_w*c_ww,
+               "var_b": jb_u*jb_u*c_uu,
+               "cov_ab": ja_u*jb_u*c_uu + ja_w*jb_u*c_uw,
+               "n": n, "rmse": np.sqrt(ssr/n), "resid_mean": np.sum(resid, axis=-1)/n,
+               "resid_max": np.abs(resid).max(axis=-1, initial=0), "r2": 1 - ssr/ss_tot}
+
+    bad = (n < 3) | ~(np.abs(det) > 1e-15) | ~np.isfinite(out["a"]) | ~np.isfinite(out["b"])
+    for k in out:
+        if k != "n":
+            out[k] = np.where(bad, np.nan, out[k])
+    return (out)
+
+
+def select(adcp, flx, start, end, depth=0, time_tol="10min"):
+    """function to choose data to work with by lake and time interal, choose a depth to create tables of a single depth
+    adcp can also be the path of a stacked table, then only the time interval (and depth column) is read from disk
+    every flx reading is paired with the nearest adcp ensemble (within time_tol) of the bin facing its sensor,
+    see tmodel.align; depth=0 pairs all sensor depths, the adcp table then holds time, mb and bin_depth"""
+    if isinstance(adcp, str):
+        cols = None if depth <= 0 else ['time', str(depth)+".61"]
+        adcp = read_table(adcp, columns=cols, start=start, end=end)
+
+    paired = align(adcp, flx, start, end, depths=[depth] if depth > 0 else None, time_tol=time_tol)
+    select_flx = paired[['time', 'Temperature_C', 'Depth_m']]
+    if depth > 0:
+        select_adp = paired[['adcp_time', 'mb']].rename(columns={'adcp_time': 'time', 'mb': str(depth)+".61"})
     else:
-        n = np.abs(len(select_flx) - len(select_adp))
-        drop(select_flx, n)
-        print("Dropped "+str(n)+" random values from select_flx")
+        select_adp = paired[['adcp_time', 'mb', 'bin_depth']].rename(columns={'adcp_time': 'time'})
 
     print(len(select_flx), "flx", len(select_adp), "adp")
     return(select_adp, select_flx)
 
 
-def model_fit(adcp, flx, start, end, depth=0):
+def model_fit(adcp, flx, start, end, depth=0, lod=None):
+    """lod: draw the points as a density grid, see tmodel.lod; by default when there are more than LOD_POINTS"""
     sel = select(adcp, flx, start, end, depth=depth)
     sel_adp, sel_flx = sel[0], sel[1]
     # the general form used is amp(temp, depth) and will be inverted in the plotting
-    backscatter = sel_adp.iloc[:,1] # backscatter
-    temperature = sel_flx['Temperature_C'] 
+    # compact float32 tables are widened so the fit runs in double precision
+    backscatter = sel_adp.iloc[:,1].astype(float) # backscatter
+    temperature = sel_flx['Temperature_C'].astype(float)
 
     # general form found from rearranging existing theory to find temp(amp)
-    def fit(x, a, b):
-        return ((x + a) * 10**(1520/(x + 273)))/b
+    fit = temp_model
     
-    # parameter fit using the above x, y values and temp function
-    popt, pcov = curve_fit(fit, temperature, backscatter)
-    popt, pcov
+    # parameter fit using the above x, y values and temp function: closed form, iterative if that fails
+    lin = linear_fit(temperature.to_numpy(), backscatter.to_numpy())
+    if np.isfinite(lin["a"]):
+        popt = (float(lin["a"]), float(lin["b"]))
+    else:
+        popt, pcov = curve_fit(fit, temperature, backscatter)
 
-    mb_temp = fit(temperature, popt[0], popt[1])
+    if lod or (lod is None and len(temperature) > LOD_POINTS):
+        # one image and one line instead of a marker per point
+        grid = grid_for(backscatter, temperature).add(backscatter, temperature)
+        grid.plot(stat="count")
+        t_line = np.linspace(temperature.min(), temperature.max(), 200)
+        plt.plot(fit(t_line, popt[0], popt[1]), t_line, color='red')
+    else:
+        mb_temp = fit(temperature, popt[0], popt[1])
 
-    plt.scatter(backscatter, temperature, marker= 'x', color='black')
-    plt.scatter(mb_temp, temperature, marker = '+', color='red') # ,popt[2],popt[3]))
+        plt.scatter(backscatter, temperature, marker= 'x', color='black')
+        plt.scatter(mb_temp, temperature, marker = '+', color='red') # ,popt[2],popt[3]))
 
     plt.grid()
     plt.xlabel('Measured Backscatter (dB)')
@@ -74,54 +131,212 @@ def model_fit(adcp, flx, start, end, depth=0):
     plt.xlim(60,75)
 
 
+def sliding_windows(start, end, length, step):
+    """(start, end) windows of the given length every step between start and end, ex: "14D", "7D" """
+    length = pd.Timedelta(length)
+    starts = pd.date_range(pd.Timestamp(start), pd.Timestamp(end) - length, freq=step)
+    return ([(x, x + length) for x in starts])
+
+
+def _fit_windows(lake, depth, time, temperature, backscatter, windows, p0=None, min_points=3):
+    """fit every window of one lake and depth in order, each one starting from the parameters of the last"""
+    rows = []
+    for start, end in windows:
+        # windows are exclusive on both ends like select
+        lo = np.searchsorted(time, np.datetime64(start), side="right")
+        hi = np.searchsorted(time, np.datetime64(end), side="left")
+        x, y = temperature[lo:hi], backscatter[lo:hi]
+        row = {"lake": lake, "depth": depth, "start": start, "end": end, "n": len(x)}
+        if len(x) < min_points:
+            rows.append(dict(row, error="too few points"))
+            continue
+        try:
+            popt, pcov = curve_fit(temp_model, x, y, p0=p0)
+        except (RuntimeError, ValueError) as error:
+            rows.append(dict(row, error=repr(error)))
+            continue
+        p0 = popt
+        resid = y - temp_model(x, *popt)
+        ss_tot = np.sum((y - y.mean())**2)
+        row.update({"a": popt[0], "b": popt[1], "var_a": pcov[0, 0], "var_b": pcov[1, 1], "cov_ab": pcov[0, 1],
+                    "rmse": np.sqrt(np.mean(resid**2)), "resid_mean": resid.mean(),
+                    "resid_max": np.abs(resid).max(), "r2": 1 - np.sum(resid**2)/ss_tot if ss_tot > 0 else np.nan,
+                    "error": None})
+        rows.append(row)
+    return (rows)
+
+
+# cells of one padded block handed to linear_fit by _linear_windows
+LINEAR_BLOCK = 1 << 22
+FIT_COLUMNS = ("a", "b", "var_a", "var_b", "cov_ab", "rmse", "resid_mean", "resid_max", "r2")
+
+
+def _linear_windows(jobs, workers=1):
+    """every window of every job solved by linear_fit; windows are padded into blocks of similar width
+    (power of two classes, at most LINEAR_BLOCK cells a block) so memory follows the points inside the
+    windows rather than their number times the widest one. Windows it can not solve are fitted with
+    curve_fit, across workers processes"""
+    spans, rows, series = [], [], []
+    for lake, depth, time, temperature, backscatter, windows, p0, min_points in jobs:
+        for start, end in windows:
+            lo = np.searchsorted(time, np.datetime64(start), side="right")
+            hi = np.searchsorted(time, np.datetime64(end), side="left")
+            spans.append((lo, hi))
+            series.append((temperature, backscatter))
+            rows.append({"lake": lake, "depth": depth, "start": start, "end": end, "n": hi - lo})
+
+    widths = np.array([hi - lo for lo, hi in spans], dtype=np.int64)
+    fit = {c: np.full(len(spans), np.nan) for c in FIT_COLUMNS}
+    group = np.ceil(np.log2(np.maximum(widths, 1))).astype(int)
+    for g in np.unique(group):
+        members = np.flatnonzero(group == g)
+        width = int(widths[members].max())
+        step = max(1, LINEAR_BLOCK // max(width, 1))
+        for i in range(0, len(members), step):
+            block = members[i:i + step]
+            x = np.full((len(block), width), np.nan)
+            y = np.full((len(block), width), np.nan)
+            for j, k in enumerate(block):
+                lo, hi = spans[k]
+                x[j, :hi - lo], y[j, :hi - lo] = series[k][0][lo:hi], series[k][1][lo:hi]
+            out = linear_fit(x, y)
+            for c in FIT_COLUMNS:
+                fit[c][block] = out[c]
+
+    # windows degenerate for the closed form, by job: the iterative fit has a go at them
+    retry = {}
+    k = 0
+    for j, (lake, depth, time, temperature, backscatter, windows, p0, min_points) in enumerate(jobs):
+        for start, end in windows:
+            row = rows[k]
+            if row["n"] < min_points:
+                row["error"] = "too few points"
+            elif np.isfinite(fit["a"][k]):
+                row.update({c: fit[c][k] for c in FIT_COLUMNS})
+                row["error"] = None
+            else:
+                retry.setdefault(j, []).append(k)
+            k += 1
+
+    args = [jobs[j][:5] + ([(rows[k]["start"], rows[k]["end"]) for k in ks],) + jobs[j][6:] for j, ks in retry.items()]
+    if workers <= 1 or len(args) <= 1:
+        parts = [_fit_windows(*x) for x in args]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_fit_windows, *zip(*args)))
+    for ks, part in zip(retry.values(), parts):
+        for k, r in zip(ks, part):
+            rows[k].update(r)
+    return (rows)
+
+
+def fit_grid(adcp, flx, depths, windows, workers=1, p0=None, time_tol="10min", min_points=3, method="linear"):
+    """ Fit temp_model for every lake, sensor depth and time window, without plotting
+
+    Parameters
+    ----------
+    adcp : dataframe, str or dict
+        mb table or path of a stacked table; a dict of lake: table or path for several lakes
+    flx : dataframe or dict
+        flx readings of the lake, a dict with the same keys as adcp for several lakes
+    depths : list
+        sensor depths in m, ex: range(1, 21)
+    windows : list
+        (start, end) pairs, exclusive like select; see sliding_windows
+    workers : int
+        processes for the curve_fit fits: every window with method="curve_fit", only the windows the
+        closed form can not solve with method="linear". Every lake and depth is one job fitting its
+        windows in order, each window warm started from the parameters of the previous one
+    p0 : tuple
+        initial (a, b) of the first window with curve_fit, its default when None
+    time_tol : str
+        largest time difference between a flx reading and its adcp ensemble, see tmodel.align
+    min_points : int
+        windows with fewer pairs are reported but not fitted
+    method : str
+        "linear" solves every window of every lake and depth in one linear_fit call, windows it
+        cannot solve are retried with curve_fit; "curve_fit" fits each window iteratively
+
+    Returns
+    -------
+    dataframe
+        one row per lake, depth and window: n, a, b, their (co)variances, rmse, resid_mean, resid_max, r2
+        and error, None when the fit converged
+    """
+    if not isinstance(adcp, dict):
+        adcp, flx = {None: adcp}, {None: flx}
+    windows = sorted((pd.Timestamp(s), pd.Timestamp(e)) for s, e in windows)
+    first, last = min(s for s, e in windows), max(e for s, e in windows)
+
+    # ---- pairs of every lake and depth, aligned once for the whole span
+    jobs = []
+    for lake, tbl in adcp.items():
+        if isinstance(tbl, str):
+            tbl = read_table(tbl, columns=["time"] + [str(d) + ".61" for d in depths], start=first, end=last)
+        paired = align(tbl, flx[lake], first, last, depths=depths, time_tol=time_tol)
+        for depth, x in paired.groupby("Depth_m", sort=True):
+            jobs.append((lake, depth, x["time"].to_numpy(), x["Temperature_C"].to_numpy(dtype=float),
+                         x["mb"].to_numpy(dtype=float), windows, p0, min_points))
+
+    if method == "linear":
+        rows = _linear_windows(jobs, workers)
+    elif workers <= 1:
+        rows = [r for job in jobs for r in _fit_windows(*job)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = [r for part in pool.map(_fit_windows, *zip(*jobs)) for r in part] if jobs else []
+
+    cols = ["lake", "depth", "start", "end", "n", "a", "b", "var_a", "var_b", "cov_ab", "rmse", "resid_mean",
+            "resid_max", "r2", "error"]
+    return (pd.DataFrame(rows, columns=cols))
+
+
     # aggregating the selecet for bubble plot function
-def sel_bub(adcp, flx, start, end):
+def sel_bub(adcp, flx, start, end, time_tol="15min"):
+    """pair every flx (time, depth) reading with the nearest adcp (time, bin) value, straight from the wide
+    table without resampling or melting it, see tmodel.align; all sensor depths at once
+    returns time, Temperature_C, depth (bin depth) and mb"""
+    if isinstance(adcp, str):
+        adcp = read_table(adcp, start=start, end=end)
+    paired = align(adcp, flx, start, end, time_tol=time_tol)
+    return(paired[['time', 'Temperature_C', 'bin_depth', 'mb']].rename(columns={'bin_depth': 'depth'}))
 
-    # resample and reshape the adcp dataframe
-    rsmp = adcp.resample('15T', on ='time', label='right', closed='right', origin='start').mean()
-    df = rsmp.reset_index([0])
-    adp_melt = pd.melt(df, id_vars='time').rename(columns={'variable':'depth','value':'mb'})
-    
-    # ensure proper format and date range selection
-    adp_melt['time'] = pd.to_datetime(adcp['time'])
-    select_adp = adp_melt[(adp_melt['time'] > start) & (adp_melt['time'] < end)]
-
-    flx['time'] = pd.to_datetime(flx['Timestamp_EST'])
-    flx = flx[['time', 'Temperature_C', 'Depth_m']]
-    select_flx = flx[(flx['time'] > start) & (flx['time'] < end)]
-
-    # check that we are still working with standard dataframes
-    adp_sel = pd.DataFrame(select_adp)
-    flx_sel = pd.DataFrame(select_flx)
-
-    # ensure data types and column names are similar before merge
-    flx_sel[["depth"]] = flx_sel[['Depth_m']].astype(float)+0.61
-    flx_sel['Temperature_C'] = flx_sel['Temperature_C'].astype(float)
-    adp_sel[['depth']] = adp_sel[['depth']].astype(float)
-    adp_sel['mb'] = adp_sel['mb'].astype(float)
-
-    # sort dfs by time
-    adp_sel = adp_sel.sort_values(by='time')
-    flx_sel = flx_sel.sort_values(by='time')
-    # drop uneeded columns
-    flx_sel = flx_sel.drop(columns='Depth_m')
-
-    # merge the two data frames, returns an empty mb column
-    merged_df = adp_sel.merge(flx_sel, how='right', left_on=['time','depth','mb'], right_on=['time','depth','Temperature_C'])
-    # merge the merged df with the adp df to obtain the mb values
-    merged_df2 = pd.merge_asof(merged_df, adp_sel, on='time', direction='nearest', allow_exact_matches=False)
-    # drop the excess columns obtained by the last merge
-    merge_df = merged_df2.drop(columns=['depth_x','mb_x'])
-
-    return(merge_df)
-
-def bubble(ary=[], *prms):
-    """Takes array as input with the following format [adcp_df, flx_df, start_time, end_time]"""
-    df = sel_bub(ary[0], ary[1], ary[2], ary[3])
+def bubble(ary=[], *prms, lod=None, chunk="30D"):
+    """Takes array as input with the following format [adcp_df, flx_df, start_time, end_time]
+    lod: draw the mean mb of a time x temperature density grid, see tmodel.lod; the pairs are joined and
+    added chunk by chunk so long records (ex: a stacked table path over a season) never sit in memory at once.
+    By default the grid is used once more than LOD_POINTS points have been joined, fewer are drawn as
+    bubbles from the chunks already joined; lod=False joins the whole window in one go"""
+    adcp, flx, start, end = ary[0], ary[1], pd.Timestamp(ary[2]), pd.Timestamp(ary[3])
+    if lod is not False:
+        edges = sorted(set(list(pd.date_range(start, end, freq=chunk)) + [start, end]))
+        kept, grid = [], None
+        for k, (lo, hi) in enumerate(zip(edges[:-1], edges[1:])):
+            # windows are exclusive, later chunks start just before their edge so no reading falls between
+            df = sel_bub(adcp, flx, lo if k == 0 else lo - pd.Timedelta(1, "ns"), hi)
+            if grid is not None:
+                grid.add(df['time'], df['Temperature_C'], df['mb'])
+                continue
+            kept.append(df)
+            if lod or sum(len(x) for x in kept) > LOD_POINTS:
+                t = pd.to_datetime(flx['Timestamp_EST'] if 'Timestamp_EST' in flx else flx['time'])
+                temps = flx['Temperature_C'][(t > start) & (t < end)].astype(float)
+                grid = DensityGrid((start, end), (temps.min(), temps.max()))
+                for x in kept:
+                    grid.add(x['time'], x['Temperature_C'], x['mb'])
+                kept = []
+        if grid is not None:
+            im = grid.plot(stat="mean")
+            plt.colorbar(im, orientation='vertical', location='right')
+            plt.grid(linestyle='-', color='grey', alpha=0.5)
+            return
+        df = pd.concat(kept, ignore_index=True)
+    else:
+        df = sel_bub(adcp, flx, start, end)
     time = df['time']
     temp = df['Temperature_C']
-    depth = df['depth_y']
-    mb = df['mb_y']
+    depth = df['depth']
+    mb = df['mb']
 
     plt.scatter(time, temp, s=depth*20, c=mb, alpha=0.2, cmap='seismic', edgecolors='black', linewidths=1)
     plt.colorbar(orientation='vertical', location='right')
@@ -134,8 +349,9 @@ if __name__ == '__main__':
     # pull the adcp tables
     lake = "OWS19"
     directory = "/home/mpoe/adcp_habs/data/adcp_tables_stacked/"
-    adp = pd.read_csv(directory + "/" + lake + "/" + lake + "_mb_av.csv")
-    adp_ts = pd.read_csv(directory + "/" + lake + "/" + lake + "_converted_time_series.csv")
+    # paths only, select reads the window and depth column it needs; see tables.storage.read_window
+    adp = directory + "/" + lake + "/" + lake + "_mb_av.csv"
+    adp_ts = directory + "/" + lake + "/" + lake + "_converted_time_series.csv"
 
     # choose lake, year, interval and depth
     start = "2019-07-01 12:00:00"